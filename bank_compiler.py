@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compile the questions directory into a single pre-indexed bank file.
+
+Layout of the bank file:
+
+    b"QBNK" | format version (uint16) | index length (uint32) | index | lecture blobs
+
+The index is compact JSON listing, for every lecture file, its subject
+directory, lecture number, the (offset, length) of its blob and the
+(mtime_ns, size) of the source file it was compiled from. Each blob is the
+lecture's JSON without whitespace. Readers memory-map the file and decode a
+lecture only when it is first asked for.
+
+Usage: python bank_compiler.py [questions_dir] [output_file]
+"""
+
+import os
+import re
+import sys
+import json
+import mmap
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_QUESTIONS_DIR = os.path.join(BASE_DIR, "quiz_data", "questions")
+DEFAULT_BANK_FILE = os.path.join(BASE_DIR, "quiz_data", "questions.bank")
+
+MAGIC = b"QBNK"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHI")
+
+LECTURE_FILE_PATTERN = re.compile(r"^lecture(\d+)\.json$")  # Also used by question_bank.py
+
+
+def compile_bank(questions_dir=DEFAULT_QUESTIONS_DIR, output_file=DEFAULT_BANK_FILE):
+    """Build the bank file from every lecture file under questions_dir. Returns the number of lectures."""
+    index = []
+    blobs = []
+    offset = 0
+    for subject_dir in sorted(os.listdir(questions_dir)):
+        subject_path = os.path.join(questions_dir, subject_dir)
+        if not os.path.isdir(subject_path):
+            continue
+        for name in sorted(os.listdir(subject_path)):
+            match = LECTURE_FILE_PATTERN.match(name)
+            if not match:
+                continue
+            path = os.path.join(subject_path, name)
+            st = os.stat(path)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    content = json.load(f)
+            except (OSError, ValueError) as e:  # ValueError covers bad JSON and non-UTF-8 files
+                logger.error(f"Skipping {path}: {e}")
+                continue
+            blob = json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            index.append([subject_dir, int(match.group(1)), offset, len(blob), st.st_mtime_ns, st.st_size])
+            blobs.append(blob)
+            offset += len(blob)
+
+    index_bytes = json.dumps(index, separators=(',', ':')).encode('utf-8')
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(index_bytes)))
+        f.write(index_bytes)
+        for blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, output_file)
+    logger.info(f"Compiled {len(index)} lectures ({offset} bytes) into {output_file}.")
+    return len(index)
+
+
+class CompiledBank:
+    """Read-only, memory-mapped view of a bank file built by compile_bank()"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.index = self._read_index()
+        except (struct.error, ValueError, TypeError) as e:
+            # Truncated or corrupt: report every kind of damage as ValueError, like a wrong magic number
+            self._map.close()
+            raise ValueError(f"{path} is not a valid version {FORMAT_VERSION} question bank file: {e}") from e
+
+    def _read_index(self):
+        """{(subject_dir, lecture_num): (absolute offset, length, (mtime_ns, size) of the source file)}"""
+        magic, version, index_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("wrong magic number or version")
+        data_start = HEADER.size + index_length
+        if data_start > len(self._map):
+            raise ValueError("index runs past the end of the file")
+        index = {
+            (subject_dir, lecture_num): (data_start + offset, length, (mtime_ns, size))
+            for subject_dir, lecture_num, offset, length, mtime_ns, size
+            in json.loads(self._map[HEADER.size:data_start])
+        }
+        if any(offset + length > len(self._map) for offset, length, _ in index.values()):
+            raise ValueError("lecture data runs past the end of the file")
+        return index
+
+    def read(self, subject_dir, lecture_num):
+        """Decode one lecture, or return None if it isn't in the bank"""
+        entry = self.index.get((subject_dir, lecture_num))
+        if entry is None:
+            return None
+        offset, length, _ = entry
+        return json.loads(self._map[offset:offset + length])
+
+    def close(self):
+        self._map.close()
+
+
+def main(argv):
+    questions_dir = argv[1] if len(argv) > 1 else DEFAULT_QUESTIONS_DIR
+    output_file = argv[2] if len(argv) > 2 else DEFAULT_BANK_FILE
+    count = compile_bank(questions_dir, output_file)
+    print(f"Compiled {count} lectures into {output_file}.")
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    sys.exit(main(sys.argv))
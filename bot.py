@@ -2,16 +2,33 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
+import random
+import signal
+import asyncio
 import logging
-import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext
-
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
-)
+import secrets
+from telegram import Update
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, CallbackContext
+
+from question_bank import QuestionBank, subject_dir_name
+from leaderboard_store import LeaderboardStore, current_month
+from render_cache import RenderCache
+from keyboards import KeyboardRegistry
+from user_locks import KeyedLock, serialized_per_user
+from sessions import QuizSession, SessionStore
+from session_persistence import SQLiteSessionBackend
+from webhook_server import WebhookServer
+from rate_limiter import OutboundRateLimiter, sent_with_priority, PRIORITY_FEEDBACK
+from question_timers import TimingWheel
+from callback_data import Action, decode as decode_callback
+from metrics import Metrics, MetricsServer, instrumented
+from log_pipeline import setup_logging
+
+# Enable logging: LOG_MODE=json queues records and writes them as JSON lines from a background thread
+LOG_MODE = os.environ.get("LOG_MODE", "text")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_SAMPLE_EVERY = {"button_press": 10, "answer": 10}  # Keep 1 in N of these high-volume INFO events
+log_listener = setup_logging(LOG_MODE, LOG_LEVEL, sample_every=LOG_SAMPLE_EVERY)
 logger = logging.getLogger(__name__)
 
 # Telegram Bot Token
@@ -19,20 +36,48 @@ TOKEN = "7705883869:AAF5KsIeyMnUWfQC3qGbeJNJwmasR_8Xi3c" # Make sure this is cor
 
 # Quiz Configuration
 SUBJECTS = ["Internet Technology", "Software Engineering", "Data Structures", "Computer Networks", "Database Systems"]
-LECTURES_PER_SUBJECT = 14  # Default, can be modified
 QUESTIONS_PER_LECTURE = 10
-# TIMER_SECONDS = 30 # Removed timer
+SHUFFLE_QUESTIONS = True  # Ask questions in a random order with shuffled options
+QUESTIONS_PER_QUIZ = 10  # Questions picked from the lecture for a shuffled quiz
+QUESTION_BANK_RELOAD_SECONDS = 30  # How often lecture files are checked for changes
+CONCURRENT_UPDATES = 32  # How many updates are handled at the same time
+TELEGRAM_GLOBAL_RATE = 30  # Messages per second the bot sends across all chats
+TELEGRAM_CHAT_RATE = 1  # Messages per second the bot sends to a single chat
+SESSION_TTL_SECONDS = 60 * 60  # Quizzes idle for longer than this are dropped
+MAX_SESSIONS = 10000  # Least recently used quizzes are dropped beyond this
+SESSION_SWEEP_SECONDS = 5 * 60  # How often idle quizzes are swept
+SESSION_FLUSH_SECONDS = 5  # How often changed quizzes are saved to disk
+LEADERBOARD_FLUSH_SECONDS = 5  # How often buffered scores are written to the leaderboard database
+LEADERBOARD_FLUSH_UPDATES = 100  # Buffered scores that trigger an early write
+
+# Webhook mode: an HTTP server receives updates instead of long polling.
+# It is used when BOT_MODE=webhook, which is the default once WEBHOOK_URL is set.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # Public https base URL registered with Telegram
+BOT_MODE = os.environ.get("BOT_MODE", "webhook" if WEBHOOK_URL else "polling")
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = int(os.environ.get("PORT", 8443))
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_QUEUE_SIZE = 1000  # Updates waiting for a worker before requests get a 503
+QUESTION_TIMER_SECONDS = int(os.environ.get("QUESTION_TIMER_SECONDS", 0))  # Time limit per question, 0 for untimed quizzes
+QUESTION_TIMER_TICK = 0.5  # Resolution of question timers in seconds
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))  # Prometheus /metrics endpoint, 0 to disable it
 
 # File paths
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 QUIZ_DATA_DIR = os.path.join(BASE_DIR, "quiz_data")
 QUESTIONS_DIR = os.path.join(QUIZ_DATA_DIR, "questions")
-LEADERBOARD_FILE = os.path.join(QUIZ_DATA_DIR, "leaderboard.json")
+QUESTION_BANK_FILE = os.path.join(QUIZ_DATA_DIR, "questions.bank")  # Built by bank_compiler.py, optional
+LEADERBOARD_FILE = os.path.join(QUIZ_DATA_DIR, "leaderboard.json")  # Legacy format, migrated on startup
+LEADERBOARD_DB = os.path.join(QUIZ_DATA_DIR, "leaderboard.sqlite3")
+LEADERBOARD_JOURNAL = os.path.join(QUIZ_DATA_DIR, "leaderboard.journal")  # Scores not yet in LEADERBOARD_DB
+SESSIONS_DB = os.path.join(QUIZ_DATA_DIR, "sessions.sqlite3")
 
 # Ensure directories exist
 os.makedirs(QUESTIONS_DIR, exist_ok=True)
 for subject in SUBJECTS:
-    subject_dir = os.path.join(QUESTIONS_DIR, subject.lower().replace(" ", "_"))
+    subject_dir = os.path.join(QUESTIONS_DIR, subject_dir_name(subject))
     os.makedirs(subject_dir, exist_ok=True)
 
 # Egyptian Arabic humor responses
@@ -48,167 +93,170 @@ LOW_SCORE_RESPONSES = [
     "طب ما تحاول تاني؟ 🙈 المذاكرة هي الحل!"
 ]
 
-# User session storage
-user_data = {}
+# Updates from the same user are handled one at a time, different users in parallel
+user_locks = KeyedLock()
 
-def get_or_create_leaderboard():
-    """Get existing leaderboard or create a new one"""
-    current_month = datetime.datetime.now().strftime("%Y-%B")
+# All lecture files, loaded once at startup and refreshed in the background
+question_bank = QuestionBank(QUESTIONS_DIR, SUBJECTS, compiled_path=QUESTION_BANK_FILE)
 
-    if os.path.exists(LEADERBOARD_FILE):
-        try:
-            with open(LEADERBOARD_FILE, 'r', encoding='utf-8') as f:
-                leaderboard = json.load(f)
-                # Reset if month changed
-                if leaderboard.get("version") != current_month:
-                    logger.info(f"Leaderboard month changed from {leaderboard.get('version')} to {current_month}. Resetting scores.")
-                    leaderboard = {
-                        "version": current_month,
-                        "users": {}
-                    }
-        except json.JSONDecodeError:
-             logger.error(f"Error decoding leaderboard JSON from {LEADERBOARD_FILE}. Creating new one.")
-             leaderboard = {
-                 "version": current_month,
-                 "users": {}
-             }
-    else:
-        logger.info(f"Leaderboard file {LEADERBOARD_FILE} not found. Creating new one.")
-        leaderboard = {
-            "version": current_month,
-            "users": {}
-        }
-
-    return leaderboard
-
-def save_leaderboard(leaderboard):
-    """Save leaderboard to file"""
+def resolve_session_questions(subject_index, lecture_num):
+    """Question list a saved session refers to, or None if it is gone"""
+    if not (0 <= subject_index < len(SUBJECTS)):
+        return None
+    quiz_content = question_bank.get_lecture(SUBJECTS[subject_index], lecture_num)
+    return quiz_content.get("questions") if quiz_content else None
+
+# User session storage, saved in batches so quizzes survive a restart
+session_backend = SQLiteSessionBackend(SESSIONS_DB, max_age_seconds=SESSION_TTL_SECONDS)
+sessions = SessionStore(ttl_seconds=SESSION_TTL_SECONDS, capacity=MAX_SESSIONS,
+                        backend=session_backend, resolve_questions=resolve_session_questions)
+
+# Monthly scores, one atomic row update per finished quiz
+leaderboard_store = LeaderboardStore(LEADERBOARD_DB, top_size=10, journal_path=LEADERBOARD_JOURNAL,
+                                     flush_every=LEADERBOARD_FLUSH_UPDATES)
+
+# Rendered top-10 message, re-rendered only when the top of the board changes
+leaderboard_cache = RenderCache()
+# Rendered all-time top-10, which only changes when a month is archived
+all_time_cache = RenderCache()
+
+# Time limits of the questions on screen in timed quizzes, by user id
+question_timers = TimingWheel(tick_seconds=QUESTION_TIMER_TICK)
+
+# Prebuilt inline keyboards shared by all handlers
+keyboards = KeyboardRegistry()
+keyboards.ensure(SUBJECTS, question_bank.available_lectures())
+
+# Handler and Bot API timings, served on /metrics
+metrics = Metrics()
+metrics_server = None
+metrics.add_gauge("live_sessions", "Quizzes in progress.", lambda: len(sessions))
+metrics.add_gauge("leaderboard_users", "Users on this month's leaderboard.", lambda: len(leaderboard_store))
+metrics.add_gauge("user_updates_dropped", "Updates dropped because their user already had updates pending.",
+                  lambda: user_locks.dropped)
+metrics.add_gauge("question_timers", "Running question time limits.", lambda: len(question_timers))
+metrics.add_stats("sessions", "Quiz session store counter", lambda: sessions.stats())
+metrics.add_stats("leaderboard_cache", "Rendered leaderboard cache counter", lambda: leaderboard_cache.stats())
+metrics.add_stats("all_time_cache", "Rendered all-time leaderboard cache counter", lambda: all_time_cache.stats())
+
+async def refresh_question_bank(context: CallbackContext) -> None:
+    """Periodic job: pick up new or edited lecture files without a restart."""
     try:
-        with open(LEADERBOARD_FILE, 'w', encoding='utf-8') as f:
-            json.dump(leaderboard, f, ensure_ascii=False, indent=2)
-    except IOError as e:
-        logger.error(f"Error saving leaderboard to {LEADERBOARD_FILE}: {e}")
-
-
-def get_or_create_question_file(subject, lecture_num):
-    """Get existing question file or create a sample one"""
-    subject_dir = os.path.join(QUESTIONS_DIR, subject.lower().replace(" ", "_"))
-    file_path = os.path.join(subject_dir, f"lecture{lecture_num}.json")
-
-    if not os.path.exists(file_path):
-        logger.info(f"Question file {file_path} not found. Creating sample questions.")
-        # Create sample questions if file doesn't exist
-        sample_questions = {
-            "lecture": lecture_num,
-            "questions": []
-        }
-
-        # Generate 10 sample questions
-        for i in range(1, QUESTIONS_PER_LECTURE + 1):
-            question = {
-                "text": f"Sample question {i} for {subject} Lecture {lecture_num}?",
-                "options": [
-                    f"Option A for question {i}",
-                    f"Option B for question {i}",
-                    f"Option C for question {i}",
-                    f"Option D for question {i}"
-                ],
-                "correct": 0,  # First option is correct in sample
-                "explanation": f"This is a sample explanation for question {i}."
-            }
-            sample_questions["questions"].append(question)
-
-        # Save sample questions
-        try:
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(sample_questions, f, ensure_ascii=False, indent=2)
-            logger.info(f"Sample question file created at {file_path}")
-        except IOError as e:
-            logger.error(f"Error creating sample question file {file_path}: {e}")
-            return {"lecture": lecture_num, "questions": []} # Return empty if error
-
-    # Load and return questions
+        await asyncio.to_thread(question_bank.refresh)
+        # Lecture menus offer exactly the lectures that are in the bank now
+        keyboards.ensure(SUBJECTS, question_bank.available_lectures())
+    except Exception as e:
+        logger.error(f"Error refreshing question bank: {e}")
+
+async def get_session(user_id):
+    """Return the user's quiz session, restoring it from disk after a restart if needed"""
+    session = sessions.get(user_id)
+    if session is None and sessions.may_have_saved(user_id):
+        record = await asyncio.to_thread(session_backend.load, user_id)
+        session = sessions.restore(user_id, record)
+        if session is not None:
+            logger.info("Restored saved quiz session for user %s.", user_id,
+                        extra={"event": "session_restored", "user_id": user_id})
+    return session
+
+async def flush_sessions(context: CallbackContext) -> None:
+    """Periodic job: write changed quiz sessions to disk in one batch."""
+    records = sessions.take_dirty()
+    if not records:
+        return
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (IOError, json.JSONDecodeError) as e:
-        logger.error(f"Error loading question file {file_path}: {e}")
-        return {"lecture": lecture_num, "questions": []} # Return empty if error
+        await asyncio.to_thread(session_backend.save_many, records)
+    except Exception as e:
+        logger.error(f"Error saving {len(records)} quiz sessions: {e}. Retrying on the next flush.")
+        sessions.requeue(records)
 
-def start(update: Update, context: CallbackContext) -> None:
+async def flush_leaderboard(context: CallbackContext) -> None:
+    """Periodic job: write buffered quiz scores to the leaderboard database in one batch."""
+    try:
+        await asyncio.to_thread(leaderboard_store.flush)
+    except Exception as e:
+        logger.error(f"Error writing buffered leaderboard scores: {e}")
+
+async def save_state_on_shutdown(application: Application) -> None:
+    """Write out pending session changes and buffered scores, and stop serving metrics, before the process exits."""
+    await flush_sessions(None)
+    session_backend.close()
+    await flush_leaderboard(None)
+    await stop_metrics_server()
+
+async def start_metrics_server(application: Application) -> None:
+    """Serve /metrics on METRICS_HOST:METRICS_PORT, unless METRICS_PORT is 0."""
+    global metrics_server
+    if not METRICS_PORT or metrics_server is not None:
+        return
+    server = MetricsServer(metrics, host=METRICS_HOST, port=METRICS_PORT)
+    try:
+        await server.start()
+    except OSError as e:
+        logger.error(f"Could not serve metrics on {METRICS_HOST}:{METRICS_PORT}: {e}")
+        return
+    metrics_server = server
+
+async def stop_metrics_server() -> None:
+    global metrics_server
+    if metrics_server is not None:
+        await metrics_server.stop()
+        metrics_server = None
+
+async def sweep_sessions(context: CallbackContext) -> None:
+    """Periodic job: drop abandoned quizzes."""
+    evicted = sessions.evict_idle()
+    if evicted:
+        logger.info(f"Evicted {evicted} idle quiz sessions. Session stats: {sessions.stats()}")
+
+@serialized_per_user(user_locks)
+@instrumented(metrics, "start")
+async def start(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /start is issued."""
     user = update.effective_user
-    logger.info(f"User {user.id} ({user.first_name}) started the bot.")
-    keyboard = [
-        [InlineKeyboardButton("Choose Subject 📚", callback_data='choose_subject')],
-        [InlineKeyboardButton("Leaderboard 🏆", callback_data='leaderboard')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    update.message.reply_text(
+    logger.info("User %s (%s) started the bot.", user.id, user.first_name,
+                extra={"event": "start", "user_id": str(user.id)})
+    reply_markup = keyboards.main_menu
+
+    await update.message.reply_text(
         f'مرحباً {user.first_name}! 👋\n\n'
         f'أنا بوت الاختبارات الأكاديمية. اختر موضوعاً للبدء في الاختبار أو اعرض لوحة المتصدرين.',
         reply_markup=reply_markup
     )
 
-def button_callback(update: Update, context: CallbackContext) -> None:
+@serialized_per_user(user_locks)
+async def button_callback(update: Update, context: CallbackContext) -> None:
     """Handle button callbacks."""
     query = update.callback_query
-    query.answer() # Important to answer callback queries
+    await query.answer() # Important to answer callback queries
 
-    data = query.data
+    decoded = decode_callback(query.data)
     user_id = str(update.effective_user.id)
-    logger.info(f"User {user_id} pressed button with data: {data}")
+    if decoded is None:
+        logger.warning(f"Unhandled callback data from user {user_id}: {query.data}")
+        return
+    action, args = decoded
+    logger.info("User %s pressed %s %s", user_id, action.name, args,
+                extra={"event": "button_press", "user_id": user_id, "action": action.name})
 
-    if data == 'choose_subject':
-        show_subjects(update, context)
-    elif data == 'leaderboard':
-        show_leaderboard(update, context)
-    elif data.startswith('subject_'):
-        try:
-            subject_index = int(data.split('_')[1])
-            show_lectures(update, context, subject_index)
-        except (IndexError, ValueError):
-             logger.warning(f"Invalid subject callback data: {data}")
-             query.edit_message_text("حدث خطأ. يرجى المحاولة مرة أخرى.")
-    elif data.startswith('lecture_'):
-        try:
-            parts = data.split('_')
-            subject_index = int(parts[1])
-            lecture_num = int(parts[2])
-            start_quiz(update, context, subject_index, lecture_num)
-        except (IndexError, ValueError):
-             logger.warning(f"Invalid lecture callback data: {data}")
-             query.edit_message_text("حدث خطأ. يرجى المحاولة مرة أخرى.")
-    elif data.startswith('answer_'):
-        try:
-            parts = data.split('_')
-            selected_option = int(parts[1])
-            handle_answer(update, context, selected_option)
-        except (IndexError, ValueError):
-             logger.warning(f"Invalid answer callback data: {data}")
-             query.edit_message_text("حدث خطأ. يرجى المحاولة مرة أخرى.")
-    elif data == 'next_question':
-        show_next_question(update, context)
-    elif data == 'main_menu':
-        show_main_menu(update, context)
-    else:
-        logger.warning(f"Unhandled callback data: {data}")
+    if action is not Action.ANSWER:
+        question_timers.cancel(user_id)  # The timed question is leaving the screen
+
+    handler, argc = CALLBACK_HANDLERS[action]
+    if len(args) != argc:
+        logger.warning(f"Invalid callback data for {action.name}: {args}")
+        await query.edit_message_text("حدث خطأ. يرجى المحاولة مرة أخرى.")
+        return
+    await handler(update, context, *args)
 
 
-def show_subjects(update: Update, context: CallbackContext) -> None:
+async def show_subjects(update: Update, context: CallbackContext) -> None:
     """Show available subjects."""
-    keyboard = []
-    for i, subject in enumerate(SUBJECTS):
-        keyboard.append([InlineKeyboardButton(subject, callback_data=f'subject_{i}')])
-
-    keyboard.append([InlineKeyboardButton("Back to Main Menu", callback_data='main_menu')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = keyboards.subjects
 
     query = update.callback_query
     try:
-        query.edit_message_text(
+        await query.edit_message_text(
             text="اختر الموضوع الذي ترغب في اختباره:",
             reply_markup=reply_markup
         )
@@ -216,278 +264,276 @@ def show_subjects(update: Update, context: CallbackContext) -> None:
         logger.error(f"Error editing message in show_subjects: {e}")
 
 
-def show_lectures(update: Update, context: CallbackContext, subject_index: int) -> None:
+async def show_lectures(update: Update, context: CallbackContext, subject_index: int) -> None:
     """Show available lectures for a subject."""
     if not (0 <= subject_index < len(SUBJECTS)):
         logger.warning(f"Invalid subject index {subject_index} in show_lectures.")
         query = update.callback_query
-        query.edit_message_text("حدث خطأ في اختيار الموضوع. يرجى المحاولة مرة أخرى.")
+        await query.edit_message_text("حدث خطأ في اختيار الموضوع. يرجى المحاولة مرة أخرى.")
         return
 
     subject = SUBJECTS[subject_index]
-    keyboard = []
-
-    # Create rows with 3 lectures each
-    row = []
-    for i in range(1, LECTURES_PER_SUBJECT + 1):
-        row.append(InlineKeyboardButton(f"Lecture {i}", callback_data=f'lecture_{subject_index}_{i}'))
-        if len(row) == 3:
-            keyboard.append(row)
-            row = []
-
-    # Add any remaining lectures
-    if row:
-        keyboard.append(row)
-
-    keyboard.append([InlineKeyboardButton("Back to Subjects", callback_data='choose_subject')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = keyboards.lectures[subject_index]
+    if keyboards.lecture_numbers[subject_index]:
+        text = f"اختر المحاضرة من {subject}:"
+    else:
+        text = f"لا توجد محاضرات متاحة حالياً في {subject}."
 
     query = update.callback_query
     try:
-        query.edit_message_text(
-            text=f"اختر المحاضرة من {subject}:",
+        await query.edit_message_text(
+            text=text,
             reply_markup=reply_markup
         )
     except Exception as e:
         logger.error(f"Error editing message in show_lectures: {e}")
 
 
-def start_quiz(update: Update, context: CallbackContext, subject_index: int, lecture_num: int) -> None:
+async def start_quiz(update: Update, context: CallbackContext, subject_index: int, lecture_num: int) -> None:
     """Start a quiz for the selected subject and lecture."""
     user_id = str(update.effective_user.id)
 
     if not (0 <= subject_index < len(SUBJECTS)):
         logger.warning(f"Invalid subject index {subject_index} in start_quiz.")
         query = update.callback_query
-        query.edit_message_text("حدث خطأ في اختيار الموضوع. يرجى المحاولة مرة أخرى.")
+        await query.edit_message_text("حدث خطأ في اختيار الموضوع. يرجى المحاولة مرة أخرى.")
         return
 
     subject = SUBJECTS[subject_index]
-    logger.info(f"User {user_id} starting quiz for {subject} - Lecture {lecture_num}")
+    logger.info("User %s starting quiz for %s - Lecture %s", user_id, subject, lecture_num,
+                extra={"event": "quiz_started", "user_id": user_id, "subject": subject, "lecture": lecture_num})
 
-    # Load questions
-    quiz_content = get_or_create_question_file(subject, lecture_num)
-    questions = quiz_content.get("questions", [])
+    # Only the in-memory bank is consulted; a lecture deleted since the menu was sent has no questions
+    quiz_content = question_bank.get_lecture(subject, lecture_num)
+    questions = quiz_content["questions"] if quiz_content is not None else []
 
     if not questions:
-         logger.warning(f"No questions found for {subject} - Lecture {lecture_num}. File path: {os.path.join(QUESTIONS_DIR, subject.lower().replace(' ', '_'), f'lecture{lecture_num}.json')}")
+         logger.warning(f"No questions found for {subject} - Lecture {lecture_num}. File path: {question_bank.lecture_path(subject, lecture_num)}")
          query = update.callback_query
-         query.edit_message_text(f"عذراً، لا توجد أسئلة متاحة لهذه المحاضرة ({subject} - المحاضرة {lecture_num}). يرجى اختيار محاضرة أخرى.")
+         await query.edit_message_text(f"عذراً، لا توجد أسئلة متاحة لهذه المحاضرة ({subject} - المحاضرة {lecture_num}). يرجى اختيار محاضرة أخرى.")
          return
 
     # Initialize user session
-    user_data[user_id] = {
-        'subject': subject,
-        'lecture': lecture_num,
-        'questions': questions,
-        'current_question': 0,
-        'score': 0,
-        'start_time': datetime.datetime.now() # Keep start time for potential future use (e.g., duration tracking)
-    }
+    seed = random.getrandbits(32) if SHUFFLE_QUESTIONS else None
+    session = sessions.put(user_id, QuizSession(subject_index, lecture_num, questions,
+                                                seed=seed, count=QUESTIONS_PER_QUIZ))
+
+    # The introduction and the first question go out in a single edit
+    intro = (
+        f"بدء الاختبار: {subject} - المحاضرة {lecture_num}\n"
+        f"عدد الأسئلة: {session.question_count}\n\n"
+        f"استعد... انطلق! 🚀\n\n"
+    )
+    rendered = render_question(session, notice=intro)
+    if rendered is None:
+        await show_quiz_results(update, context)
+        return
+    await show_question(update.callback_query, user_id, session, *rendered)
 
-    query = update.callback_query
+
+def render_question(session, notice=""):
+    """Text and keyboard for the session's current question, or None once no questions are left."""
+    position = session.current_question
+    if position >= session.question_count:
+        return None
+    question = session.question(position)
+
+    reply_markup = keyboards.answer_keyboard(question, session.nonce, position, session.option_order(position))
+    question_text = question.text
+    message_text = (
+        f"{notice}"
+        f"سؤال {position + 1}/{session.question_count}\n\n"
+        + (f"⏱️ {QUESTION_TIMER_SECONDS} ثانية\n\n" if QUESTION_TIMER_SECONDS else "")
+        + f"{question_text}"
+    )
+    return message_text, reply_markup
+
+
+async def edit_quiz_message(query, session, text, reply_markup=None) -> None:
+    """Edit the quiz message, counting the request (and the callback answer before it) for the quiz."""
+    session.api_calls += 2
     try:
-        query.edit_message_text(
-            text=f"بدء الاختبار: {subject} - المحاضرة {lecture_num}\n"
-                 f"عدد الأسئلة: {len(questions)}\n\n" # Removed timer mention
-                 # f"الوقت لكل سؤال: {TIMER_SECONDS} ثانية\n\n" # Removed timer mention
-                 f"استعد... انطلق! 🚀"
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+    except Exception as e:
+        # Handle potential "Message is not modified" error if user clicks quickly
+        if "Message is not modified" not in str(e):
+            logger.error(f"Error editing quiz message: {e}")
+
+
+async def show_question(query, user_id, session, text, reply_markup) -> None:
+    """Put the session's current question on screen and, in timed quizzes, start its timer."""
+    await edit_quiz_message(query, session, text, reply_markup)
+    if QUESTION_TIMER_SECONDS:
+        message = query.message
+        question_timers.schedule(user_id, QUESTION_TIMER_SECONDS,
+                                 (session.current_question, message.chat_id, message.message_id))
+
+
+async def expire_question_timers(context: CallbackContext) -> None:
+    """Periodic job: time out questions that were not answered in time."""
+    for user_id, (question_idx, chat_id, message_id) in question_timers.advance():
+        context.application.create_task(
+            user_locks.run(int(user_id), question_timed_out(context.bot, user_id, question_idx, chat_id, message_id))
         )
-        # Show first question immediately after brief delay for message edit
-        context.job_queue.run_once(lambda ctx: show_next_question(update, ctx), 0.5, context=context)
 
+
+@sent_with_priority(PRIORITY_FEEDBACK)
+async def question_timed_out(bot, user_id, question_idx, chat_id, message_id) -> None:
+    """Move past a question the user didn't answer in time."""
+    session = await get_session(user_id)
+    if session is None or session.current_question != question_idx:
+        return  # Quiz ended or the question was answered while the timer fired
+
+    logger.info("User %s ran out of time on Q%s.", user_id, question_idx,
+                extra={"event": "question_timed_out", "user_id": user_id, "question": question_idx})
+    session.current_question += 1
+    sessions.mark_dirty(user_id)
+
+    session.api_calls += 1
+    try:
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text="⏱️ انتهى الوقت!\n\n"
+                 "لم يتم اختيار إجابة في الوقت المحدد.",
+            reply_markup=keyboards.next_question_keyboard(session.nonce, session.current_question)
+        )
     except Exception as e:
-        logger.error(f"Error editing message in start_quiz: {e}")
+        logger.error(f"Error editing message in question_timed_out: {e}")
 
 
-def show_next_question(update: Update, context: CallbackContext) -> None:
+@sent_with_priority(PRIORITY_FEEDBACK)
+async def show_next_question(update: Update, context: CallbackContext, nonce: int, question_idx: int) -> None:
     """Show the next question in the quiz."""
     query = update.callback_query
     user_id = str(update.effective_user.id)
 
-    if user_id not in user_data:
-        logger.warning(f"User {user_id} attempted to continue quiz, but no session data found.")
-        if query:
-             try:
-                 query.edit_message_text("حدث خطأ في الجلسة. يرجى بدء اختبار جديد.")
-             except Exception as e:
-                 logger.error(f"Error editing message in show_next_question (no session): {e}")
+    session = await get_session(user_id)
+    if session is None or nonce != session.nonce or question_idx != session.current_question:
+        # A repeated tap after the results, or a button of an earlier quiz or question: leave the screen alone
+        logger.info("User %s pressed a stale next button (Q%s).", user_id, question_idx,
+                    extra={"event": "stale_next", "user_id": user_id, "question": question_idx})
         return
 
-    session = user_data[user_id]
+    rendered = render_question(session)
 
     # Check if quiz is complete
-    if session['current_question'] >= len(session['questions']):
-        logger.info(f"User {user_id} completed quiz for {session['subject']} - Lecture {session['lecture']}.")
-        show_quiz_results(update, context)
+    if rendered is None:
+        logger.info("User %s completed quiz for %s - Lecture %s.", user_id, SUBJECTS[session.subject_index],
+                    session.lecture, extra={"event": "quiz_completed", "user_id": user_id})
+        await show_quiz_results(update, context)
         return
 
-    # Get current question
-    question_idx = session['current_question']
-    question = session['questions'][question_idx]
-
-    # Create options keyboard
-    keyboard = []
-    options = question.get("options", [])
-    if not options:
-         logger.error(f"Question {question_idx} for {session['subject']} L{session['lecture']} has no options.")
-         # Handle error - maybe skip question or end quiz
-         if query:
-             query.edit_message_text("حدث خطأ في السؤال الحالي. جار الانتقال للسؤال التالي.")
-         session['current_question'] += 1
-         context.job_queue.run_once(lambda ctx: show_next_question(update, ctx), 1, context=context) # Try next question after delay
-         return
-
-    for i, option in enumerate(options):
-        keyboard.append([InlineKeyboardButton(f"{chr(65+i)}. {option}", callback_data=f'answer_{i}')])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    # Display question (without timer)
-    question_text = question.get("text", "Error: Question text missing.")
-    message_text = (
-        f"سؤال {question_idx + 1}/{len(session['questions'])}\n\n"
-        # f"⏱️ {TIMER_SECONDS} ثانية\n\n" # Removed timer display
-        f"{question_text}"
-    )
-
-    if query:
-        try:
-            query.edit_message_text(
-                text=message_text,
-                reply_markup=reply_markup
-            )
-        except Exception as e:
-            # Handle potential "Message is not modified" error if user clicks 'Next' quickly
-            if "Message is not modified" not in str(e):
-                 logger.error(f"Error editing message in show_next_question: {e}")
-    else:
-         # This case might happen if called directly (e.g., from start_quiz delay)
-         # Need a way to send the message if query is None
-         # For now, log it. A better solution might involve passing chat_id/message_id
-         logger.warning("show_next_question called without a callback query.")
-         # Attempt to send a new message if possible (requires chat_id)
-         # chat_id = update.effective_chat.id # This might not be available if update is None
-         # context.bot.send_message(chat_id=chat_id, text=message_text, reply_markup=reply_markup)
-
+    await show_question(query, user_id, session, *rendered)
 
-# Removed question_timeout function entirely
 
-def handle_answer(update: Update, context: CallbackContext, selected_option: int) -> None:
+@sent_with_priority(PRIORITY_FEEDBACK)
+async def handle_answer(update: Update, context: CallbackContext, nonce: int, question_idx: int,
+                        selected_option: int) -> None:
     """Handle user answer selection."""
     query = update.callback_query
     user_id = str(update.effective_user.id)
 
-    if user_id not in user_data:
+    session = await get_session(user_id)
+    if session is None:
         logger.warning(f"User {user_id} answered, but no session data found.")
-        query.edit_message_text("حدث خطأ في الجلسة. يرجى بدء اختبار جديد.")
+        await query.edit_message_text("حدث خطأ في الجلسة. يرجى بدء اختبار جديد.")
         return
 
-    session = user_data[user_id]
-    question_idx = session['current_question']
+    if nonce != session.nonce or question_idx != session.current_question:
+        # A button of an earlier quiz or question: ignore it rather than answer the current one
+        logger.info("User %s pressed a stale answer button (Q%s).", user_id, question_idx,
+                    extra={"event": "stale_answer", "user_id": user_id, "question": question_idx})
+        return
+
+    question_timers.cancel(user_id)
 
     # Prevent answering same question multiple times or after quiz ends
-    if question_idx >= len(session['questions']):
+    if question_idx >= session.question_count:
          logger.warning(f"User {user_id} tried to answer after quiz ended.")
-         query.edit_message_text("لقد انتهى الاختبار بالفعل.")
+         await query.edit_message_text("لقد انتهى الاختبار بالفعل.")
          return
 
-    question = session['questions'][question_idx]
-    correct_option = question.get('correct')
-    options = question.get('options', [])
-    explanation = question.get('explanation', 'لا يوجد شرح متاح.')
-
-    # Validate selected_option and correct_option
-    if not (isinstance(correct_option, int) and 0 <= correct_option < len(options)):
-         logger.error(f"Invalid correct answer index ({correct_option}) for Q{question_idx} in {session['subject']} L{session['lecture']}.")
-         query.edit_message_text("حدث خطأ في بيانات السؤال. جار الانتقال للسؤال التالي.")
-         session['current_question'] += 1
-         context.job_queue.run_once(lambda ctx: show_next_question(update, ctx), 1, context=context)
-         return
+    # Questions were validated when the bank loaded them, so only the button needs checking
+    question = session.question(question_idx)
+    correct_option = question.correct
+    options = question.options
 
-    if not (0 <= selected_option < len(options)):
+    if selected_option >= len(options):
          logger.warning(f"Invalid selected option index ({selected_option}) received from user {user_id}.")
-         query.edit_message_text("خيار غير صالح. يرجى المحاولة مرة أخرى.")
+         await query.edit_message_text("خيار غير صالح. يرجى المحاولة مرة أخرى.")
          return # Don't advance, let user try again? Or show correct answer? Let's show correct.
 
+    # Buttons carry the displayed position; map it back to the option in the file
+    option_order = session.option_order(question_idx)
+    chosen_option = option_order[selected_option]
+
     # Check if answer is correct
-    is_correct = selected_option == correct_option
+    is_correct = chosen_option == correct_option
     if is_correct:
-        session['score'] += 1
-        logger.info(f"User {user_id} answered Q{question_idx} correctly.")
+        session.score += 1
+        logger.info("User %s answered Q%s correctly.", user_id, question_idx,
+                    extra={"event": "answer", "user_id": user_id, "question": question_idx, "correct": True})
     else:
-        logger.info(f"User {user_id} answered Q{question_idx} incorrectly (chose {selected_option}, correct was {correct_option}).")
+        logger.info("User %s answered Q%s incorrectly (chose %s, correct was %s).", user_id, question_idx,
+                    chosen_option, correct_option,
+                    extra={"event": "answer", "user_id": user_id, "question": question_idx, "correct": False})
 
 
-    # Prepare feedback message
-    correct_letter = chr(65 + correct_option)
+    # Prepare feedback message, lettered as the options were shown
+    correct_letter = chr(65 + option_order.index(correct_option))
     selected_letter = chr(65 + selected_option)
 
-    feedback = f"سؤال {question_idx + 1}:\n\n{question.get('text', 'N/A')}\n\n"
+    feedback = f"سؤال {question_idx + 1}:\n\n{question.text}\n\n"
 
     if is_correct:
-        feedback += f"✅ إجابتك صحيحة: {selected_letter}. {options[selected_option]}\n\n"
+        feedback += f"✅ إجابتك صحيحة: {selected_letter}. {options[chosen_option]}\n\n"
     else:
-        feedback += f"❌ إجابتك: {selected_letter}. {options[selected_option]}\n"
+        feedback += f"❌ إجابتك: {selected_letter}. {options[chosen_option]}\n"
         feedback += f"✅ الإجابة الصحيحة: {correct_letter}. {options[correct_option]}\n\n"
 
-    feedback += f"💡 {explanation}"
+    feedback += f"💡 {question.explanation}"
 
     # Advance to next question state
-    session['current_question'] += 1
+    session.current_question += 1
+    sessions.mark_dirty(user_id)
 
     # Show feedback
-    try:
-        query.edit_message_text(
-            text=feedback,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("التالي", callback_data='next_question')]
-            ])
-        )
-    except Exception as e:
-        logger.error(f"Error editing message in handle_answer: {e}")
+    await edit_quiz_message(query, session, feedback,
+                            keyboards.next_question_keyboard(session.nonce, session.current_question))
 
 
-def show_quiz_results(update: Update, context: CallbackContext) -> None:
+def record_quiz_score(user_id, name, score):
+    """Add a finished quiz to the leaderboard and return the user's new position"""
+    # Anti-cheat: Limit score updates? (Not implemented yet as per prompt)
+    # Simple score addition for now
+    leaderboard_store.add_score(user_id, name, score)
+    return leaderboard_store.rank(user_id)
+
+
+async def show_quiz_results(update: Update, context: CallbackContext) -> None:
     """Show quiz results and update leaderboard."""
     query = update.callback_query
     user_id = str(update.effective_user.id)
     user = update.effective_user
 
-    if user_id not in user_data:
+    session = await get_session(user_id)
+    if session is None:
         logger.warning(f"Attempted to show results for user {user_id}, but no session data found.")
         if query:
-             query.edit_message_text("حدث خطأ في الجلسة. يرجى بدء اختبار جديد.")
+             await query.edit_message_text("حدث خطأ في الجلسة. يرجى بدء اختبار جديد.")
         return
 
-    session = user_data[user_id]
-    score = session['score']
-    total = len(session['questions'])
-    subject = session['subject']
-    lecture = session['lecture']
+    score = session.score
+    total = session.question_count
+    subject = SUBJECTS[session.subject_index]
+    lecture = session.lecture
 
-    logger.info(f"Showing results for user {user_id}: {score}/{total} on {subject} L{lecture}.")
+    logger.info("Showing results for user %s: %s/%s on %s L%s.", user_id, score, total, subject, lecture,
+                extra={"event": "quiz_results", "user_id": user_id, "score": score, "total": total})
 
-    # Update leaderboard
-    leaderboard = get_or_create_leaderboard()
-    if user_id not in leaderboard['users']:
-        leaderboard['users'][user_id] = {
-            'name': user.first_name,
-            'score': 0,
-            'last_active': datetime.datetime.now().strftime("%Y-%m-%d")
-        }
-
-    # Anti-cheat: Limit score updates? (Not implemented yet as per prompt)
-    # Simple score addition for now
-    leaderboard['users'][user_id]['score'] += score
-    leaderboard['users'][user_id]['last_active'] = datetime.datetime.now().strftime("%Y-%m-%d")
-    save_leaderboard(leaderboard)
-
-    # Get user position
-    sorted_users = sorted(leaderboard['users'].items(),
-                         key=lambda x: x[1]['score'],
-                         reverse=True)
-    position = next((i + 1 for i, (uid, _) in enumerate(sorted_users) if uid == user_id), 0)
+    # Update leaderboard and get user position (SQLite work runs off the event loop)
+    position = await asyncio.to_thread(record_quiz_score, user_id, user.first_name, score)
 
     # Prepare results message
     if score == total:
@@ -507,38 +553,24 @@ def show_quiz_results(update: Update, context: CallbackContext) -> None:
         f"{result_message}"
     )
 
-    if query:
-        try:
-            query.edit_message_text(
-                text=final_text,
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("العودة إلى القائمة الرئيسية", callback_data='main_menu')]
-                ])
-            )
-        except Exception as e:
-            logger.error(f"Error editing message in show_quiz_results: {e}")
+    await edit_quiz_message(query, session, final_text, keyboards.back_to_main_menu)
 
     # Clean up session
-    del user_data[user_id]
-    logger.info(f"Cleaned up session data for user {user_id}.")
-
+    sessions.pop(user_id)
+    logger.debug("Cleaned up session data for user %s.", user_id)
 
-def show_leaderboard(update: Update, context: CallbackContext) -> None:
-    """Show the leaderboard."""
-    leaderboard = get_or_create_leaderboard()
 
-    # Sort users by score
-    sorted_users = sorted(leaderboard.get('users', {}).items(),
-                         key=lambda x: x[1].get('score', 0),
-                         reverse=True)
+def render_leaderboard():
+    """Build the top-10 leaderboard message and its keyboard."""
+    top_users = leaderboard_store.top(10) # Show top 10
 
     # Prepare leaderboard message
-    message = f"🏆 المتصدرون الشهريون 🏆\n({leaderboard.get('version', 'N/A')})\n\n"
+    message = f"🏆 المتصدرون الشهريون 🏆\n({leaderboard_store.version()})\n\n"
 
-    if not sorted_users:
+    if not top_users:
         message += "لا يوجد متسابقون بعد. كن أول من يظهر هنا!"
     else:
-        for i, (user_id, user_info) in enumerate(sorted_users[:10]): # Show top 10
+        for i, (user_id, user_info) in enumerate(top_users):
             medal = ""
             if i == 0:
                 medal = "👑 "
@@ -551,29 +583,84 @@ def show_leaderboard(update: Update, context: CallbackContext) -> None:
             score = user_info.get('score', 0)
             message += f"{i+1}. {medal}{name}: {score} نقطة\n"
 
+    return message, keyboards.back_to_main_menu
+
+
+async def show_leaderboard(update: Update, context: CallbackContext) -> None:
+    """Show the leaderboard."""
+    cache_key = (current_month(), leaderboard_store.top_generation)
+    cached = leaderboard_cache.lookup(cache_key)
+    if cached is None:
+        cached = await asyncio.to_thread(render_leaderboard)
+        leaderboard_cache.put(cache_key, cached)
+    message, reply_markup = cached
+
     query = update.callback_query
     try:
-        query.edit_message_text(
+        await query.edit_message_text(
             text=message,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("العودة إلى القائمة الرئيسية", callback_data='main_menu')]
-            ])
+            reply_markup=reply_markup
         )
     except Exception as e:
         logger.error(f"Error editing message in show_leaderboard: {e}")
 
 
-def show_main_menu(update: Update, context: CallbackContext) -> None:
+def render_all_time_leaderboard():
+    """Build the all-time top-10 message (archived months only) and its keyboard."""
+    top_users = leaderboard_store.all_time_top(10)
+
+    message = "🏅 المتصدرون على مر الشهور 🏅\n\n"
+    if not top_users:
+        message += "لا توجد شهور مؤرشفة بعد."
+    else:
+        for i, (user_id, user_info) in enumerate(top_users):
+            message += f"{i+1}. {user_info['name']}: {user_info['score']} نقطة ({user_info['months']} شهر)\n"
+
+    return message, keyboards.back_to_main_menu
+
+
+async def show_all_time_leaderboard(update: Update, context: CallbackContext) -> None:
+    """Show the best totals over all archived months."""
+    cache_key = current_month()  # The archive only grows at a month rollover
+    cached = all_time_cache.lookup(cache_key)
+    if cached is None:
+        cached = await asyncio.to_thread(render_all_time_leaderboard)
+        all_time_cache.put(cache_key, cached)
+    message, reply_markup = cached
+
+    query = update.callback_query
+    try:
+        await query.edit_message_text(text=message, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error editing message in show_all_time_leaderboard: {e}")
+
+
+async def show_my_history(update: Update, context: CallbackContext) -> None:
+    """Show the user's scores in past months."""
+    user_id = str(update.effective_user.id)
+    history = await asyncio.to_thread(leaderboard_store.history, user_id, 12)
+
+    message = "📜 نتائجك في الشهور السابقة 📜\n\n"
+    if not history:
+        message += "لا توجد نتائج مؤرشفة لك بعد."
+    else:
+        for version, score in history:
+            message += f"{version}: {score} نقطة\n"
+
+    query = update.callback_query
+    try:
+        await query.edit_message_text(text=message, reply_markup=keyboards.back_to_main_menu)
+    except Exception as e:
+        logger.error(f"Error editing message in show_my_history: {e}")
+
+
+async def show_main_menu(update: Update, context: CallbackContext) -> None:
     """Show the main menu."""
-    keyboard = [
-        [InlineKeyboardButton("Choose Subject 📚", callback_data='choose_subject')],
-        [InlineKeyboardButton("Leaderboard 🏆", callback_data='leaderboard')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = keyboards.main_menu
 
     query = update.callback_query
     try:
-        query.edit_message_text(
+        await query.edit_message_text(
             text='مرحباً بك في بوت الاختبارات الأكاديمية! 👋\n\n'
                  'اختر موضوعاً للبدء في الاختبار أو اعرض لوحة المتصدرين.',
             reply_markup=reply_markup
@@ -581,44 +668,139 @@ def show_main_menu(update: Update, context: CallbackContext) -> None:
     except Exception as e:
         logger.error(f"Error editing message in show_main_menu: {e}")
 
-def error_handler(update: object, context: CallbackContext) -> None:
+async def error_handler(update: object, context: CallbackContext) -> None:
     """Log Errors caused by Updates."""
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
     # Optionally notify user about the error
     if isinstance(update, Update) and update.effective_message:
         try:
-            update.effective_message.reply_text("عذراً، حدث خطأ ما. يرجى المحاولة مرة أخرى لاحقاً.")
+            await update.effective_message.reply_text("عذراً، حدث خطأ ما. يرجى المحاولة مرة أخرى لاحقاً.")
         except Exception as e:
             logger.error(f"Failed to send error message to user: {e}")
 
 
-def main() -> None:
-    """Start the bot."""
-    logger.info("Starting bot...")
-    # Create the Updater and pass it your bot's token
-    updater = Updater(TOKEN)
-
-    # Get the dispatcher to register handlers
-    dispatcher = updater.dispatcher
+# Callback action -> (handler(update, context, *arguments), number of arguments the button carries)
+CALLBACK_HANDLERS = {
+    Action.MAIN_MENU: (show_main_menu, 0),
+    Action.CHOOSE_SUBJECT: (show_subjects, 0),
+    Action.LEADERBOARD: (show_leaderboard, 0),
+    Action.ALL_TIME: (show_all_time_leaderboard, 0),
+    Action.MY_HISTORY: (show_my_history, 0),
+    Action.SUBJECT: (show_lectures, 1),
+    Action.LECTURE: (start_quiz, 2),
+    Action.ANSWER: (handle_answer, 3),
+    Action.NEXT_QUESTION: (show_next_question, 2),
+}
+# Every route is timed under its action's name
+CALLBACK_HANDLERS = {action: (instrumented(metrics, action.name)(handler), argc)
+                     for action, (handler, argc) in CALLBACK_HANDLERS.items()}
+
+
+async def run_webhook(application: Application) -> None:
+    """Run the bot behind the built-in webhook server until SIGINT/SIGTERM."""
+    async def handle_update(data):
+        await application.process_update(Update.de_json(data, application.bot))
+
+    server = WebhookServer(handle_update, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                           secret_token=WEBHOOK_SECRET, queue_size=WEBHOOK_QUEUE_SIZE,
+                           workers=CONCURRENT_UPDATES)
+    metrics.add_stats("webhook", "Webhook server counter", server.stats)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    await server.start()
+    try:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                                               secret_token=WEBHOOK_SECRET,
+                                               allowed_updates=Update.ALL_TYPES)
+            logger.info(f"Webhook registered at {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}.")
+        else:
+            logger.warning("WEBHOOK_URL is not set; serving the webhook without registering it with Telegram.")
+        await stop.wait()
+    finally:
+        await server.stop()
+        logger.info(f"Webhook server stopped. Stats: {server.stats()}")
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def load_data() -> None:
+    """Load the question bank and build its menu keyboards."""
+    question_bank.load_all()
+    keyboards.ensure(SUBJECTS, question_bank.available_lectures())
+
+
+def build_application() -> Application:
+    """Create the Application with all handlers and periodic jobs registered."""
+    # Create the Application and pass it your bot's token.
+    # Updates from different users are handled concurrently instead of one at a time.
+    # Outgoing requests are paced to stay under Telegram's flood limits, and timed
+    rate_limiter = OutboundRateLimiter(overall_rate=TELEGRAM_GLOBAL_RATE, per_chat_rate=TELEGRAM_CHAT_RATE,
+                                       observe=metrics.observe_request)
+    metrics.add_stats("outbound", "Outbound request scheduler counter", rate_limiter.stats)
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .rate_limiter(rate_limiter)
+        .post_init(start_metrics_server)
+        .post_shutdown(save_state_on_shutdown)
+        .build()
+    )
 
     # Register command handlers
-    dispatcher.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("start", start))
 
     # Register callback query handlers
-    dispatcher.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(CallbackQueryHandler(button_callback))
 
     # Register error handler
-    dispatcher.add_error_handler(error_handler)
+    application.add_error_handler(error_handler)
+
+    # Watch the questions directory for added or edited lecture files
+    application.job_queue.run_repeating(refresh_question_bank, interval=QUESTION_BANK_RELOAD_SECONDS,
+                                        first=QUESTION_BANK_RELOAD_SECONDS)
+
+    # Drop quizzes that were abandoned half way
+    application.job_queue.run_repeating(sweep_sessions, interval=SESSION_SWEEP_SECONDS,
+                                        first=SESSION_SWEEP_SECONDS)
 
-    # Start the Bot
-    updater.start_polling()
-    logger.info("Bot started polling.")
+    # Save in-flight quizzes in batches so a restart doesn't lose them
+    application.job_queue.run_repeating(flush_sessions, interval=SESSION_FLUSH_SECONDS,
+                                        first=SESSION_FLUSH_SECONDS)
+    application.job_queue.run_repeating(flush_leaderboard, interval=LEADERBOARD_FLUSH_SECONDS,
+                                        first=LEADERBOARD_FLUSH_SECONDS)
+    if QUESTION_TIMER_SECONDS:
+        application.job_queue.run_repeating(expire_question_timers, interval=QUESTION_TIMER_TICK,
+                                            first=QUESTION_TIMER_TICK)
+    return application
+
+
+def main() -> None:
+    """Start the bot."""
+    logger.info("Starting bot...")
+    load_data()
+    leaderboard_store.migrate_from_json(LEADERBOARD_FILE)
+    application = build_application()
 
     # Run the bot until you press Ctrl-C
-    updater.idle()
+    if BOT_MODE == "webhook":
+        logger.info("Bot starting in webhook mode.")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("Bot started polling.")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
     logger.info("Bot stopped.")
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compact encoding of inline button callback data.
+
+A button's data is a format version byte, an action code byte and up to a
+few unsigned 32-bit arguments, packed little-endian and written as unpadded
+URL-safe base64. An answer button (quiz nonce, question index, option) takes
+19 characters, well under Telegram's 64-byte limit.
+"""
+
+import enum
+import base64
+import struct
+import binascii
+
+VERSION = 1
+_HEADER = struct.Struct("<BB")
+_MAX_ARGS = 4
+
+
+class Action(enum.IntEnum):
+    MAIN_MENU = 1
+    CHOOSE_SUBJECT = 2
+    LEADERBOARD = 3
+    ALL_TIME = 4
+    MY_HISTORY = 5
+    SUBJECT = 6  # subject_index
+    LECTURE = 7  # subject_index, lecture_num
+    ANSWER = 8  # quiz nonce, question_index, option
+    NEXT_QUESTION = 9  # quiz nonce, question_index to show next
+
+
+# Buttons sent before this encoding existed that can still be honoured
+_LEGACY = {
+    'main_menu': (Action.MAIN_MENU, ()),
+    'choose_subject': (Action.CHOOSE_SUBJECT, ()),
+    'leaderboard': (Action.LEADERBOARD, ()),
+}
+
+
+def encode(action, *args):
+    """callback_data string for `action` with integer arguments"""
+    raw = _HEADER.pack(VERSION, action) + struct.pack(f"<{len(args)}I", *args)
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def decode(data):
+    """Return (Action, args tuple), or None for data this version doesn't understand"""
+    legacy = _LEGACY.get(data)
+    if legacy is not None:
+        return legacy
+    try:
+        raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    if len(raw) < _HEADER.size or (len(raw) - _HEADER.size) % 4:
+        return None
+    version, action = _HEADER.unpack_from(raw)
+    argc = (len(raw) - _HEADER.size) // 4
+    if version != VERSION or argc > _MAX_ARGS:
+        return None
+    try:
+        action = Action(action)
+    except ValueError:
+        return None
+    return action, struct.unpack_from(f"<{argc}I", raw, _HEADER.size)
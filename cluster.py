@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Run the bot as one front process plus N worker processes.
+
+The front process receives updates (long polling, or the webhook server when
+BOT_MODE=webhook) and routes each one to a worker chosen by the Telegram user
+id, so a user's quiz session always lives in the same worker. Workers run the
+normal handlers from bot.py. Leaderboard writes from all workers go through a
+single writer thread in the front process, which owns the LeaderboardStore.
+If a worker exits, the front process stops the whole cluster (exiting with 1)
+rather than leave that worker's users unanswered, so a supervisor can restart it.
+
+Usage: python cluster.py [number_of_workers]   (default: BOT_WORKERS or CPU count)
+"""
+
+import os
+import sys
+import signal
+import asyncio
+import logging
+import threading
+import multiprocessing
+from queue import Full
+from multiprocessing.connection import wait
+
+from telegram import Bot, Update
+from telegram.error import InvalidToken, NetworkError, RetryAfter, TelegramError
+
+import bot
+from webhook_server import WebhookServer
+
+logger = logging.getLogger(__name__)
+
+WORKER_QUEUE_SIZE = 1000  # Updates buffered per worker before the front process waits
+WORKER_PUT_TIMEOUT = 5  # Seconds between checks for a stop while a worker's queue is full
+POLL_TIMEOUT = 30  # Long polling timeout in seconds
+POLL_ERROR_DELAY = 5  # Seconds to wait after a Bot API error before polling again
+
+# LeaderboardStore methods workers may call through the writer
+LEADERBOARD_METHODS = ("add_score", "rank", "top", "version", "get_user", "get_leaderboard", "flush",
+                       "history", "all_time_top", "__len__")
+
+
+class LeaderboardClient:
+    """Worker-side stand-in for LeaderboardStore that forwards calls to the single writer.
+
+    Calls block (bot.py makes them from worker threads) and are serialized per
+    worker over one pipe. top_generation is read from memory shared with the
+    writer, so render caches in every worker see changes made by the others.
+    """
+
+    def __init__(self, conn, top_generation):
+        self._conn = conn
+        self._top_generation = top_generation
+        self._lock = threading.Lock()
+
+    def _call(self, method, *args):
+        with self._lock:
+            self._conn.send((method, args))
+            ok, result = self._conn.recv()
+        if not ok:
+            raise RuntimeError(f"Leaderboard writer failed on {method}: {result}")
+        return result
+
+    @property
+    def top_generation(self):
+        return self._top_generation.value
+
+    def add_score(self, user_id, name, points):
+        return self._call("add_score", user_id, name, points)
+
+    def rank(self, user_id):
+        return self._call("rank", user_id)
+
+    def top(self, limit=10):
+        return self._call("top", limit)
+
+    def version(self):
+        return self._call("version")
+
+    def get_user(self, user_id):
+        return self._call("get_user", user_id)
+
+    def get_leaderboard(self):
+        return self._call("get_leaderboard")
+
+    def flush(self):
+        return self._call("flush")
+
+    def history(self, user_id, limit=12):
+        return self._call("history", user_id, limit)
+
+    def all_time_top(self, limit=10):
+        return self._call("all_time_top", limit)
+
+    def __len__(self):
+        return self._call("__len__")
+
+
+def serve_leaderboard(store, conns, top_generation):
+    """Writer loop: apply leaderboard calls from all workers until every pipe is closed"""
+    conns = list(conns)
+    while conns:
+        ready = wait(conns, timeout=bot.LEADERBOARD_FLUSH_SECONDS)
+        if not ready:
+            store.flush()  # Quiet moment: write out buffered scores
+            continue
+        for conn in ready:
+            try:
+                method, args = conn.recv()
+            except (EOFError, OSError):
+                conns.remove(conn)
+                continue
+            try:
+                if method not in LEADERBOARD_METHODS:
+                    raise ValueError(f"Unknown leaderboard method {method}")
+                reply = (True, getattr(store, method)(*args))
+            except Exception as e:
+                logger.error(f"Leaderboard writer error in {method}{args}: {e}")
+                reply = (False, repr(e))
+            top_generation.value = store.top_generation
+            try:
+                conn.send(reply)
+            except (BrokenPipeError, OSError):
+                conns.remove(conn)
+    store.close()
+
+
+def shard_for(update, workers):
+    """Worker index for an update: by user id, so a user's updates always go to the same worker"""
+    user = update.effective_user
+    return user.id % workers if user is not None else 0
+
+
+def run_worker(index, workers, updates, leaderboard_conn, top_generation):
+    """Entry point of a worker process"""
+    # The front process tells us when to stop (with a None update), after the signal reached the whole group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Each user's chat is handled by one worker, but the global send limit is shared by all
+    bot.TELEGRAM_GLOBAL_RATE = bot.TELEGRAM_GLOBAL_RATE / workers
+    # Worker i serves its metrics on METRICS_PORT + 1 + i; the front process has no handlers to time
+    bot.METRICS_PORT = bot.METRICS_PORT + 1 + index if bot.METRICS_PORT else 0
+    bot.leaderboard_store = LeaderboardClient(leaderboard_conn, top_generation)
+    bot.load_data()
+    asyncio.run(_serve_worker(index, updates))
+
+
+async def _serve_worker(index, updates):
+    application = bot.build_application()
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info(f"Worker {index} ready.")
+
+    limiter = asyncio.Semaphore(bot.CONCURRENT_UPDATES)
+    tasks = set()
+
+    async def process(data):
+        try:
+            await application.process_update(Update.de_json(data, application.bot))
+        except Exception as e:
+            logger.error(f"Worker {index} failed on update {data.get('update_id')}: {e}")
+        finally:
+            limiter.release()
+
+    while True:
+        data = await asyncio.to_thread(updates.get)
+        if data is None:
+            break
+        await limiter.acquire()
+        # Tasks start in queue order, so per-user locks keep each user's updates in order
+        task = asyncio.create_task(process(data))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await application.stop()
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    logger.info(f"Worker {index} stopped.")
+
+
+async def _route_polling(tg_bot, dispatch, stop):
+    """Poll until `stop` is set. Sets `stop` itself if polling can't go on, so the cluster shuts down."""
+    offset = None
+    try:
+        while not stop.is_set():
+            try:
+                received = await tg_bot.get_updates(offset=offset, timeout=POLL_TIMEOUT,
+                                                    allowed_updates=Update.ALL_TYPES)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except NetworkError as e:
+                logger.warning(f"Polling failed: {e}. Retrying.")
+                await asyncio.sleep(1)
+                continue
+            except InvalidToken as e:
+                logger.error(f"Polling stopped: {e}")
+                stop.set()
+                return
+            except TelegramError as e:
+                # e.g. Conflict while the previous deployment is still polling
+                logger.warning(f"Polling failed: {e}. Retrying in {POLL_ERROR_DELAY}s.")
+                await asyncio.sleep(POLL_ERROR_DELAY)
+                continue
+            for update in received:
+                offset = update.update_id + 1
+                await dispatch(update)
+    except Exception:
+        logger.exception("Polling stopped unexpectedly. Stopping the cluster.")
+        stop.set()
+        raise
+
+
+def _watch_workers(processes, stop):
+    """Set `stop` as soon as any worker process exits; its users would otherwise get no answers"""
+    loop = asyncio.get_running_loop()
+
+    def exited(process):
+        loop.remove_reader(process.sentinel)
+        process.join()  # Already exited: reaps it, so exitcode is set
+        if not stop.is_set():
+            logger.error(f"{process.name} exited unexpectedly (code {process.exitcode}). Stopping the cluster.")
+            stop.set()
+
+    for process in processes:
+        loop.add_reader(process.sentinel, exited, process)
+
+
+async def _route(queues, stop):
+    workers = len(queues)
+
+    async def dispatch(update):
+        index = shard_for(update, workers)
+        data = update.to_dict()
+        while not stop.is_set():
+            try:
+                await asyncio.to_thread(queues[index].put, data, True, WORKER_PUT_TIMEOUT)
+                return
+            except Full:
+                logger.warning(f"Worker {index} is not keeping up: its queue has been full for "
+                               f"{WORKER_PUT_TIMEOUT}s.")
+        logger.warning(f"Dropped update {update.update_id}: the cluster is stopping.")
+
+    async with Bot(bot.TOKEN) as tg_bot:
+        if bot.BOT_MODE == "webhook":
+            async def handle_update(data):
+                await dispatch(Update.de_json(data, tg_bot))
+
+            # One routing task, so a user's updates reach their worker's queue in the order received
+            server = WebhookServer(handle_update, host=bot.WEBHOOK_HOST, port=bot.WEBHOOK_PORT,
+                                   path=bot.WEBHOOK_PATH, secret_token=bot.WEBHOOK_SECRET,
+                                   queue_size=bot.WEBHOOK_QUEUE_SIZE, workers=1)
+            await server.start()
+            if bot.WEBHOOK_URL:
+                await tg_bot.set_webhook(url=bot.WEBHOOK_URL.rstrip('/') + bot.WEBHOOK_PATH,
+                                         secret_token=bot.WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+            try:
+                await stop.wait()
+            finally:
+                await server.stop()
+        else:
+            await tg_bot.delete_webhook()
+            polling = asyncio.create_task(_route_polling(tg_bot, dispatch, stop))
+            await stop.wait()
+            polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+
+
+async def _run_front(queues, processes):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    _watch_workers(processes, stop)
+    await _route(queues, stop)
+
+
+def main(argv):
+    workers = int(argv[1]) if len(argv) > 1 else int(os.environ.get("BOT_WORKERS", os.cpu_count() or 1))
+    logger.info(f"Starting bot cluster with {workers} workers in {bot.BOT_MODE} mode...")
+
+    store = bot.leaderboard_store
+    store.migrate_from_json(bot.LEADERBOARD_FILE)
+
+    context = multiprocessing.get_context("spawn")
+    top_generation = context.Value('Q', 0, lock=False)
+    queues = []
+    writer_conns = []
+    processes = []
+    for index in range(workers):
+        queue = context.Queue(maxsize=WORKER_QUEUE_SIZE)
+        writer_end, worker_end = context.Pipe()
+        process = context.Process(target=run_worker, args=(index, workers, queue, worker_end, top_generation),
+                                  name=f"bot-worker-{index}", daemon=False)
+        process.start()
+        worker_end.close()
+        queues.append(queue)
+        writer_conns.append(writer_end)
+        processes.append(process)
+
+    writer = threading.Thread(target=serve_leaderboard, args=(store, writer_conns, top_generation),
+                              name="leaderboard-writer", daemon=True)
+    writer.start()
+
+    try:
+        asyncio.run(_run_front(queues, processes))
+    finally:
+        for queue, process in zip(queues, processes):
+            if not process.is_alive():
+                queue.cancel_join_thread()  # Nobody will read what is still buffered
+                continue
+            try:
+                queue.put(None, timeout=WORKER_PUT_TIMEOUT)
+            except Full:
+                logger.error(f"{process.name} is not taking updates. Terminating it.")
+                queue.cancel_join_thread()
+                process.terminate()
+        for process in processes:
+            process.join()
+        writer.join(timeout=5)
+        logger.info("Bot cluster stopped.")
+    return 0 if all(process.exitcode == 0 for process in processes) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Crash-safe reading and writing of the bot's JSON data files.
+
+A file is never rewritten in place: the new content goes to a temporary file
+in the same directory, is fsync'd and then renamed over the old one, so a
+crash leaves either the old or the new version, never a truncated one. The
+previous versions are kept as `<file>.bak1` (newest) to `<file>.bak<N>`, and
+reading falls back to them when the file itself doesn't decode.
+"""
+
+import os
+import json
+import shutil
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+BACKUP_COUNT = 3  # Previous versions kept next to each file
+
+
+def backup_path(path, n):
+    return f"{path}.bak{n}"
+
+
+def _fsync_dir(directory):
+    """Make a rename in `directory` durable (not supported on every platform)"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _rotate_backups(path, backups):
+    for n in range(backups - 1, 0, -1):
+        if os.path.exists(backup_path(path, n)):
+            os.replace(backup_path(path, n), backup_path(path, n + 1))
+    # The current file stays in place until the new one replaces it
+    try:
+        os.link(path, backup_path(path, 1))
+    except OSError:
+        shutil.copy2(path, backup_path(path, 1))
+
+
+def write_json(path, data, backups=BACKUP_COUNT):
+    """Atomically replace `path` with compact JSON for `data`, keeping `backups` previous versions"""
+    directory = os.path.dirname(path) or "."
+    payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        if backups and os.path.exists(path):
+            _rotate_backups(path, backups)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    _fsync_dir(directory)
+
+
+def read_json(path, backups=BACKUP_COUNT):
+    """Decode `path`, falling back to its newest backup that decodes. Returns None if there is no file.
+
+    Raises ValueError if the file and all of its backups are unreadable.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger.error(f"Error decoding {path}: {e}. Trying its backups.")
+
+    for n in range(1, backups + 1):
+        candidate = backup_path(path, n)
+        try:
+            with open(candidate, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            continue
+        except ValueError as e:
+            logger.error(f"Error decoding backup {candidate}: {e}")
+            continue
+        logger.warning(f"Recovered {path} from backup {candidate}.")
+        return data
+    raise ValueError(f"{path} and its backups are all unreadable")
+
+
+def archive_json(path, label, data):
+    """Save `data` as `<name>-<label><ext>` next to `path`, unless that archive exists. Returns its path."""
+    root, ext = os.path.splitext(path)
+    archive_path = f"{root}-{label}{ext}"
+    if os.path.exists(archive_path):
+        logger.warning(f"{archive_path} already exists, not overwriting it.")
+        return archive_path
+    write_json(archive_path, data, backups=0)
+    logger.info(f"Archived {path} as {archive_path}.")
+    return archive_path
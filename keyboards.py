@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from callback_data import Action, encode
+
+logger = logging.getLogger(__name__)
+
+
+def _markup(rows):
+    """InlineKeyboardMarkup over tuples, so a shared markup can't be modified in place"""
+    return InlineKeyboardMarkup(tuple(tuple(row) for row in rows))
+
+
+class KeyboardRegistry:
+    """Inline keyboards built once and shared by every handler.
+
+    Menu keyboards depend only on the subject list and the lectures available
+    for each subject, and are rebuilt by ensure() when either changes. Answer
+    and "Next" buttons carry the quiz's nonce and position, so their keyboards
+    are assembled per question.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = None
+        self.main_menu = None
+        self.subjects = None
+        self.lectures = ()
+        self.lecture_numbers = ()  # Lecture numbers offered for each subject, by subject index
+        self.back_to_main_menu = _markup([
+            [InlineKeyboardButton("العودة إلى القائمة الرئيسية", callback_data=encode(Action.MAIN_MENU))]
+        ])
+
+    def ensure(self, subjects, available_lectures):
+        """Build the menu keyboards, or rebuild them if the configuration changed.
+
+        `available_lectures` maps each subject to the lecture numbers to offer.
+        """
+        config = (tuple(subjects), tuple(tuple(available_lectures.get(subject, ())) for subject in subjects))
+        if config == self._config:
+            return False
+        with self._lock:
+            self._build_menus(*config)
+            self._config = config
+        logger.info(f"Built menu keyboards for {len(config[0])} subjects, "
+                    f"{sum(len(numbers) for numbers in config[1])} lectures.")
+        return True
+
+    def _build_menus(self, subjects, lecture_numbers):
+        self.main_menu = _markup([
+            [InlineKeyboardButton("Choose Subject 📚", callback_data=encode(Action.CHOOSE_SUBJECT))],
+            [InlineKeyboardButton("Leaderboard 🏆", callback_data=encode(Action.LEADERBOARD))],
+            [InlineKeyboardButton("All-Time 🏅", callback_data=encode(Action.ALL_TIME)),
+             InlineKeyboardButton("My History 📜", callback_data=encode(Action.MY_HISTORY))]
+        ])
+
+        keyboard = [[InlineKeyboardButton(subject, callback_data=encode(Action.SUBJECT, i))]
+                    for i, subject in enumerate(subjects)]
+        keyboard.append([InlineKeyboardButton("Back to Main Menu", callback_data=encode(Action.MAIN_MENU))])
+        self.subjects = _markup(keyboard)
+
+        lectures = []
+        for subject_index, numbers in enumerate(lecture_numbers):
+            keyboard = []
+            # Create rows with 3 lectures each
+            row = []
+            for i in numbers:
+                row.append(InlineKeyboardButton(f"Lecture {i}", callback_data=encode(Action.LECTURE, subject_index, i)))
+                if len(row) == 3:
+                    keyboard.append(row)
+                    row = []
+            # Add any remaining lectures
+            if row:
+                keyboard.append(row)
+            keyboard.append([InlineKeyboardButton("Back to Subjects", callback_data=encode(Action.CHOOSE_SUBJECT))])
+            lectures.append(_markup(keyboard))
+        self.lectures = tuple(lectures)
+        self.lecture_numbers = lecture_numbers
+
+    @staticmethod
+    def next_question_keyboard(nonce, position):
+        """"Next" button leading to the question at `position` (or the results) of the quiz `nonce`"""
+        return _markup([[InlineKeyboardButton("التالي", callback_data=encode(Action.NEXT_QUESTION, nonce, position))]])
+
+    @staticmethod
+    def answer_keyboard(question, nonce, position, option_order):
+        """Answer keyboard for `question`, shown at `position` of the quiz `nonce`.
+
+        `option_order` lists the original option indices in display order;
+        buttons carry the displayed index.
+        """
+        labels = question.options
+        return _markup([[InlineKeyboardButton(f"{chr(65+shown)}. {labels[original]}",
+                                              callback_data=encode(Action.ANSWER, nonce, position, shown))]
+                        for shown, original in enumerate(option_order)])
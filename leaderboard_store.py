@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import sqlite3
+import logging
+import datetime
+import threading
+
+from rank_index import RankIndex
+from json_store import read_json
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scores (
+    user_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    score INTEGER NOT NULL DEFAULT 0,
+    last_active TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scores_by_score ON scores (score DESC);
+CREATE TABLE IF NOT EXISTS history (
+    user_id TEXT NOT NULL,
+    month TEXT NOT NULL,  -- 'YYYY-MM', sorts chronologically
+    version TEXT NOT NULL,
+    name TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    PRIMARY KEY (user_id, month)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS history_by_month ON history (month);  -- Archived-month check at rollover
+CREATE TABLE IF NOT EXISTS all_time (
+    user_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    months INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS all_time_by_score ON all_time (score DESC);
+"""
+
+
+def current_month():
+    """Leaderboard version string for the current month, e.g. '2025-May'"""
+    return datetime.datetime.now().strftime("%Y-%B")
+
+
+def today():
+    return datetime.datetime.now().strftime("%Y-%m-%d")
+
+
+def month_key(version):
+    """Sortable 'YYYY-MM' form of a leaderboard version string"""
+    try:
+        return datetime.datetime.strptime(version, "%Y-%B").strftime("%Y-%m")
+    except ValueError:
+        return version
+
+
+class LeaderboardStore:
+    """Monthly leaderboard stored in SQLite (WAL mode).
+
+    Finishing a quiz is a single UPSERT that increments one row, so the cost of
+    a write does not depend on the number of users. The table only ever holds
+    the current month: when the month changes the scores are cleared, exactly
+    like the old JSON file's "version" reset.
+
+    Positions are answered from an in-memory RankIndex that is loaded once
+    and updated on every increment, so rank() and top() never sort the table.
+
+    top_generation is bumped whenever a change can alter the first `top_size`
+    entries, letting callers cache anything derived from the top of the board.
+
+    With a `journal_path`, increments are written behind: each one is appended
+    to a small fsync'd journal and collected per user in memory, and flush()
+    applies the whole batch in one transaction (also done automatically after
+    `flush_every` increments). Reads merge the pending deltas, so a user's new
+    score and position are visible immediately. Journal entries carry sequence
+    numbers and the last applied one is committed with each batch, so entries
+    replayed after a crash are never counted twice.
+
+    When the month changes, its final scores are appended to the `history`
+    table (keyed by user, then month) and added to the `all_time` totals in
+    the same transaction that clears them, so past months stay queryable
+    without ever being rewritten.
+    """
+
+    def __init__(self, db_path, top_size=10, journal_path=None, flush_every=100):
+        self.db_path = db_path
+        self.top_size = top_size
+        self.journal_path = journal_path
+        self.flush_every = flush_every
+        self.top_generation = 0
+        self._conn = None
+        self._version = None  # Month last confirmed against the meta table
+        self._ranks = RankIndex()
+        self._journal = None
+        self._journal_seq = 0  # Sequence number of the last journal entry written
+        self._pending = {}  # user_id -> [name, points, last_active] not yet in the database
+        self._pending_count = 0
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # A flushed batch must be durable before its journal is truncated
+            conn.execute("PRAGMA synchronous=FULL" if self.journal_path else "PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+            self._load_ranks()
+            if self.journal_path:
+                self._open_journal()
+        return self._conn
+
+    def _load_ranks(self):
+        self._ranks.load(self._conn.execute("SELECT user_id, score FROM scores"))
+
+    def _open_journal(self):
+        """Replay journal entries that never reached the database, then open it for appending"""
+        applied = int(self._get_meta("journal_seq", 0))
+        self._journal_seq = applied
+        replayed = 0
+        good_end = 0  # Byte offset just past the last complete entry
+        torn = False
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("no end of line")  # Its write never completed
+                        seq, user_id, name, points, last_active = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Ignoring a torn entry at the end of {self.journal_path}.")
+                        torn = True
+                        break
+                    good_end += len(line)
+                    if seq <= applied:
+                        continue
+                    self._add_pending(user_id, name, points, last_active)
+                    self._journal_seq = seq
+                    replayed += 1
+        self._journal = open(self.journal_path, 'ab')
+        if torn:
+            # New entries must not be appended to the partial line, or the next replay would stop there
+            self._journal.truncate(good_end)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        if replayed:
+            logger.info(f"Replayed {replayed} leaderboard journal entries from {self.journal_path}.")
+            self._flush_locked()
+
+    def _add_pending(self, user_id, name, points, last_active):
+        entry = self._pending.get(user_id)
+        if entry is None:
+            self._pending[user_id] = [name, points, last_active]
+        else:
+            entry[1] += points
+            entry[2] = last_active
+        self._pending_count += 1
+        self._ranks.update(user_id, (self._ranks.score(user_id) or 0) + points)
+
+    def _flush_locked(self):
+        """Apply all pending increments in one transaction and truncate the journal"""
+        if not self._pending:
+            return 0
+        batch = [(user_id, name, points, last_active)
+                 for user_id, (name, points, last_active) in self._pending.items()]
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO scores (user_id, name, score, last_active) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET score = score + excluded.score, "
+                "last_active = excluded.last_active",
+                batch
+            )
+            self._set_meta("journal_seq", str(self._journal_seq))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._pending = {}
+        self._pending_count = 0
+        self._journal.truncate(0)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        return len(batch)
+
+    def flush(self):
+        """Write pending increments to the database. Returns the number of users written."""
+        with self._lock:
+            if self._journal is None:
+                return 0
+            return self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._flush_locked()
+                self._journal.close()
+                self._journal = None
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _get_meta(self, key, default=None):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self._connect().execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+
+    def _check_version(self):
+        """Reset the scores if the month changed. Must be called with the lock held."""
+        month = current_month()
+        if self._version == month:
+            return month
+        stored = self._get_meta("version")
+        if stored == month:
+            self._version = month
+            return month
+        if self._journal is not None:
+            self._flush_locked()  # Pending points belong to the month that is closing
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if stored is not None:
+                logger.info(f"Leaderboard month changed from {stored} to {month}. Archiving and resetting scores.")
+                self._archive_month(stored)
+            conn.execute("DELETE FROM scores")
+            self._set_meta("version", month)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._ranks.clear()
+        self._version = month
+        self.top_generation += 1
+        return month
+
+    def _archive_month(self, version):
+        """Append the scores of a closing month to the history. Must be called inside a transaction."""
+        key = month_key(version)
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM history WHERE month = ? LIMIT 1", (key,)).fetchone():
+            logger.warning(f"Leaderboard month {version} is already archived. Not archiving it again.")
+            return
+        conn.execute(
+            "INSERT INTO history (user_id, month, version, name, score) "
+            "SELECT user_id, ?, ?, name, score FROM scores",
+            (key, version)
+        )
+        conn.execute(
+            "INSERT INTO all_time (user_id, name, score, months) "
+            "SELECT user_id, name, score, 1 FROM scores WHERE true "
+            "ON CONFLICT(user_id) DO UPDATE SET score = score + excluded.score, "
+            "months = months + 1, name = excluded.name"
+        )
+
+    def version(self):
+        """Return the month the stored scores belong to"""
+        with self._lock:
+            return self._check_version()
+
+    def add_score(self, user_id, name, points):
+        """Atomically add points to a user's monthly score and return the new total"""
+        with self._lock:
+            self._check_version()
+            if self._journal is not None:
+                return self._add_score_buffered(user_id, name, points)
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # The display name is kept from the user's first finished quiz of the month
+                conn.execute(
+                    "INSERT INTO scores (user_id, name, score, last_active) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET score = score + excluded.score, "
+                    "last_active = excluded.last_active",
+                    (user_id, name, points, today())
+                )
+                total = conn.execute("SELECT score FROM scores WHERE user_id = ?", (user_id,)).fetchone()[0]
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._ranks.update(user_id, total)
+            self._note_top_change(user_id)
+            return total
+
+    def _add_score_buffered(self, user_id, name, points):
+        last_active = today()
+        self._journal_seq += 1
+        entry = [self._journal_seq, user_id, name, points, last_active]
+        self._journal.write((json.dumps(entry, ensure_ascii=False) + "\n").encode('utf-8'))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._add_pending(user_id, name, points, last_active)
+        self._note_top_change(user_id)
+        total = self._ranks.score(user_id)
+        if self._pending_count >= self.flush_every:
+            self._flush_locked()
+        return total
+
+    def _note_top_change(self, user_id):
+        # Scores only grow, so the top can only change if this user is in it now
+        if self._ranks.rank(user_id) <= self.top_size:
+            self.top_generation += 1
+
+    def get_user(self, user_id):
+        """Return {'name', 'score', 'last_active'} for a user, or None"""
+        with self._lock:
+            self._check_version()
+            row = self._connect().execute(
+                "SELECT name, score, last_active FROM scores WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            pending = self._pending.get(user_id)
+        if row is None and pending is None:
+            return None
+        if row is None:
+            return {'name': pending[0], 'score': pending[1], 'last_active': pending[2]}
+        if pending is None:
+            return {'name': row[0], 'score': row[1], 'last_active': row[2]}
+        return {'name': row[0], 'score': row[1] + pending[1], 'last_active': pending[2]}
+
+    def rank(self, user_id):
+        """1-based position of a user on the leaderboard, or 0 if they have no score"""
+        with self._lock:
+            self._check_version()
+            return self._ranks.rank(user_id)
+
+    def top(self, limit=10):
+        """Return [(user_id, {'name', 'score', 'last_active'}), ...] for the best `limit` users"""
+        with self._lock:
+            self._check_version()
+            ranked = self._ranks.top(limit)
+            if not ranked:
+                return []
+            placeholders = ", ".join("?" * len(ranked))
+            rows = self._connect().execute(
+                f"SELECT user_id, name, last_active FROM scores WHERE user_id IN ({placeholders})",
+                [uid for uid, _ in ranked]
+            ).fetchall()
+            info = {uid: (name, last_active) for uid, name, last_active in rows}
+            for uid, _ in ranked:
+                pending = self._pending.get(uid)
+                if pending is not None:
+                    info[uid] = (info[uid][0] if uid in info else pending[0], pending[2])
+        # Scores come from the rank index, which already includes pending increments
+        return [(uid, {'name': info[uid][0], 'score': score, 'last_active': info[uid][1]})
+                for uid, score in ranked if uid in info]
+
+    def get_leaderboard(self):
+        """Return the whole leaderboard in the legacy leaderboard.json layout"""
+        with self._lock:
+            version = self._check_version()
+            rows = self._connect().execute("SELECT user_id, name, score, last_active FROM scores").fetchall()
+            users = {uid: {'name': name, 'score': score, 'last_active': last_active}
+                     for uid, name, score, last_active in rows}
+            for uid, (name, points, last_active) in self._pending.items():
+                info = users.setdefault(uid, {'name': name, 'score': 0, 'last_active': last_active})
+                info['score'] += points
+                info['last_active'] = last_active
+        return {"version": version, "users": users}
+
+    def history(self, user_id, limit=12):
+        """Return [(version, score), ...] for a user's archived months, newest first"""
+        with self._lock:
+            self._check_version()
+            return self._connect().execute(
+                "SELECT version, score FROM history WHERE user_id = ? ORDER BY month DESC LIMIT ?",
+                (user_id, limit)
+            ).fetchall()
+
+    def all_time_top(self, limit=10):
+        """Return [(user_id, {'name', 'score', 'months'}), ...] with the best totals over all archived months"""
+        with self._lock:
+            self._check_version()
+            rows = self._connect().execute(
+                "SELECT user_id, name, score, months FROM all_time ORDER BY score DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [(uid, {'name': name, 'score': score, 'months': months}) for uid, name, score, months in rows]
+
+    def __len__(self):
+        with self._lock:
+            self._check_version()
+            return len(self._ranks)
+
+    def migrate_from_json(self, json_path):
+        """One-shot import of a legacy leaderboard.json. Returns the number of users imported.
+
+        Runs at most once per database, wherever the file is found: a legacy
+        file is only imported into an empty database, and the import (or the
+        decision to skip it) is recorded in meta. A file from an older month
+        is imported under its own version, so the usual monthly reset applies
+        to it on the next access.
+        """
+        with self._lock:
+            source = os.path.abspath(json_path)
+            if self._get_meta("migrated_from") is not None:
+                return 0
+            conn = self._connect()
+            if self._journal is not None:
+                self._flush_locked()
+            if conn.execute("SELECT EXISTS (SELECT 1 FROM scores) OR EXISTS (SELECT 1 FROM history)").fetchone()[0]:
+                # The database already has its own scores; importing would overwrite them with stale ones
+                self._set_meta("migrated_from", f"skipped:{source}")
+                logger.warning(f"{self.db_path} already has scores. Not migrating {json_path}.")
+                return 0
+            try:
+                leaderboard = read_json(json_path)
+            except ValueError as e:
+                logger.error(f"{e}. Not migrating it.")
+                return 0
+            if leaderboard is None:
+                return 0
+
+            users = leaderboard.get("users", {})
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT INTO scores (user_id, name, score, last_active) VALUES (?, ?, ?, ?)",
+                    [(str(uid), info.get('name', 'Unknown'), int(info.get('score', 0)),
+                      info.get('last_active', today()))
+                     for uid, info in users.items()]
+                )
+                self._set_meta("version", leaderboard.get("version") or current_month())
+                self._set_meta("migrated_from", source)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._version = None
+            self._load_ranks()
+            self.top_generation += 1
+            logger.info(f"Migrated {len(users)} users from {json_path} into {self.db_path}.")
+            return len(users)
+
+
+def main(argv):
+    """Command line entry point: python leaderboard_store.py <leaderboard.json> <leaderboard.sqlite3>"""
+    if len(argv) != 3:
+        print(f"Usage: {argv[0]} <leaderboard.json> <leaderboard.sqlite3>")
+        return 2
+    store = LeaderboardStore(argv[2])
+    count = store.migrate_from_json(argv[1])
+    print(f"Imported {count} users into {argv[2]}.")
+    store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    sys.exit(main(sys.argv))
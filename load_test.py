@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Offline load test: simulated students take quizzes through bot.py's handlers.
+
+No network and no token are needed. Each student sends /start, opens the
+subject menu, picks a subject and a lecture, answers every question by
+pressing one of the buttons the bot last sent, and reaches the results.
+Updates go straight to the handlers as stand-in Update/CallbackQuery objects
+that record the messages the bot edits. The question bank, leaderboard and
+saved sessions live in a temporary directory.
+
+Reports throughput, p50/p99 handler latency per action and memory per update.
+
+Usage: python load_test.py [--students N] [--concurrency C] [--api-latency MS] [--log-mode text|json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+import bot
+from callback_data import Action, encode, decode
+from question_bank import QuestionBank, subject_dir_name
+from leaderboard_store import LeaderboardStore
+from session_persistence import SQLiteSessionBackend
+from sessions import SessionStore
+from log_pipeline import setup_logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LECTURES = 14  # Lecture files written per subject
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.first_name = f"Student {user_id}"
+
+
+class FakeChat:
+    """Stand-in for the Bot API: records what the bot sends and answers after `latency` seconds"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    async def request(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeMessage:
+    def __init__(self, chat, user_id, message_id):
+        self._chat = chat
+        self.chat_id = user_id
+        self.message_id = message_id
+        self.text = None
+        self.reply_markup = None
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        await self._chat.request()
+        self.text, self.reply_markup = text, reply_markup
+        return self
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        await self._chat.request()
+        self.text, self.reply_markup = text, reply_markup
+        return self
+
+
+class FakeCallbackQuery:
+    def __init__(self, message, data):
+        self.message = message
+        self.data = data
+
+    async def answer(self, *args, **kwargs):
+        await self.message._chat.request()
+        return True
+
+    async def edit_message_text(self, text, reply_markup=None, **kwargs):
+        return await self.message.edit_text(text, reply_markup=reply_markup)
+
+
+class FakeUpdate:
+    def __init__(self, user, message=None, callback_query=None):
+        self.effective_user = user
+        self.message = message
+        self.callback_query = callback_query
+
+
+class FakeContext:
+    bot = None
+    application = None
+    job_queue = None
+
+
+def write_question_bank(questions_dir, lectures, questions_per_lecture, options=4):
+    """Create synthetic lecture files for every subject"""
+    for subject in bot.SUBJECTS:
+        subject_dir = os.path.join(questions_dir, subject_dir_name(subject))
+        os.makedirs(subject_dir, exist_ok=True)
+        for lecture in range(1, lectures + 1):
+            content = {"lecture": lecture, "questions": [
+                {
+                    "text": f"{subject} lecture {lecture} question {q}?",
+                    "options": [f"Option {o}" for o in range(options)],
+                    "correct": q % options,
+                    "explanation": f"Explanation of question {q}."
+                }
+                for q in range(questions_per_lecture)
+            ]}
+            with open(os.path.join(subject_dir, f"lecture{lecture}.json"), 'w', encoding='utf-8') as f:
+                json.dump(content, f, ensure_ascii=False)
+
+
+def isolate_bot(data_dir):
+    """Point bot.py's question bank, leaderboard and session store at data_dir"""
+    questions_dir = os.path.join(data_dir, "questions")
+    bot.QUESTIONS_DIR = questions_dir
+    bot.question_bank = QuestionBank(questions_dir, bot.SUBJECTS)
+    bot.session_backend = SQLiteSessionBackend(os.path.join(data_dir, "sessions.sqlite3"),
+                                               max_age_seconds=bot.SESSION_TTL_SECONDS)
+    bot.sessions = SessionStore(ttl_seconds=bot.SESSION_TTL_SECONDS, capacity=bot.MAX_SESSIONS,
+                                backend=bot.session_backend, resolve_questions=bot.resolve_session_questions)
+    bot.leaderboard_store = LeaderboardStore(os.path.join(data_dir, "leaderboard.sqlite3"), top_size=10,
+                                             journal_path=os.path.join(data_dir, "leaderboard.journal"),
+                                             flush_every=bot.LEADERBOARD_FLUSH_UPDATES)
+    bot.load_data()
+
+
+class Recorder:
+    """Handler latencies by action"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.updates = 0
+
+    async def send(self, handler, update, context, action):
+        started = time.perf_counter()
+        await handler(update, context)
+        self.latencies.setdefault(action, []).append(time.perf_counter() - started)
+        self.updates += 1
+
+
+def pick_button(message, rng, action):
+    """callback_data of a random button of `action` on the message's keyboard"""
+    buttons = [button.callback_data for row in message.reply_markup.inline_keyboard for button in row
+               if decode(button.callback_data)[0] is action]
+    return rng.choice(buttons)
+
+
+async def run_student(user_id, chat, recorder, rng):
+    user = FakeUser(user_id)
+    context = FakeContext()
+    message = FakeMessage(chat, user_id, message_id=user_id)
+
+    async def press(data, action):
+        query = FakeCallbackQuery(message, data)
+        await recorder.send(bot.button_callback, FakeUpdate(user, callback_query=query), context, action)
+
+    await recorder.send(bot.start, FakeUpdate(user, message=message), context, "START")
+    await press(encode(Action.CHOOSE_SUBJECT), Action.CHOOSE_SUBJECT.name)
+    await press(encode(Action.SUBJECT, rng.randrange(len(bot.SUBJECTS))), Action.SUBJECT.name)
+    await press(pick_button(message, rng, Action.LECTURE), Action.LECTURE.name)
+    # Until the results screen, or a message without buttons (a lecture with no questions)
+    while message.reply_markup not in (bot.keyboards.back_to_main_menu, None):
+        first_button = message.reply_markup.inline_keyboard[0][0].callback_data
+        if decode(first_button)[0] is Action.NEXT_QUESTION:
+            session = bot.sessions.get(str(user_id))
+            # The last "next" shows the results and records the score, so it is timed separately
+            last = session.current_question >= session.question_count
+            await press(first_button, "RESULTS" if last else Action.NEXT_QUESTION.name)
+        else:
+            await press(pick_button(message, rng, Action.ANSWER), Action.ANSWER.name)
+
+
+async def run_load(students, concurrency, api_latency, seed):
+    chat = FakeChat(api_latency)
+    recorder = Recorder()
+    rng = random.Random(seed)
+    limiter = asyncio.Semaphore(concurrency)
+
+    async def student(user_id):
+        async with limiter:
+            await run_student(user_id, chat, recorder, random.Random(rng.random()))
+
+    blocks_before = sys.getallocatedblocks()
+    started = time.perf_counter()
+    await asyncio.gather(*(student(user_id) for user_id in range(1, students + 1)))
+    elapsed = time.perf_counter() - started
+    await bot.flush_sessions(None)
+    bot.leaderboard_store.flush()
+    blocks_retained = sys.getallocatedblocks() - blocks_before
+    return recorder, chat, elapsed, blocks_retained
+
+
+async def measure_allocations(seed):
+    """Peak bytes allocated per update while one student takes a quiz alone"""
+    chat = FakeChat()
+    recorder = Recorder()
+    peaks = []
+    original_send = recorder.send
+
+    async def traced_send(handler, update, context, action):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        await original_send(handler, update, context, action)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+
+    recorder.send = traced_send
+    tracemalloc.start()
+    try:
+        await run_student(10 ** 9, chat, recorder, random.Random(seed))
+    finally:
+        tracemalloc.stop()
+    return sum(peaks) / len(peaks)
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def report(recorder, chat, elapsed, blocks_retained, peak_bytes, students):
+    print(f"{students} students, {recorder.updates} updates in {elapsed:.2f}s "
+          f"({recorder.updates / elapsed:.0f} updates/s), {chat.calls} Bot API calls "
+          f"({chat.calls / students:.1f} per quiz)")
+    print(f"{'handler':<16}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for action, latencies in sorted(recorder.latencies.items(), key=lambda item: str(item[0])):
+        latencies.sort()
+        print(f"{action:<16}{len(latencies):>8}{percentile(latencies, 0.5) * 1000:>10.3f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.3f}{latencies[-1] * 1000:>10.3f}")
+    print(f"Memory: {blocks_retained / recorder.updates:.1f} blocks retained per update, "
+          f"{peak_bytes / 1024:.1f} KiB peak allocation per update (single student, traced)")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay synthetic quiz traffic against bot.py's handlers offline.")
+    parser.add_argument("--students", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100, help="students active at the same time")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API latency in ms")
+    parser.add_argument("--lectures", type=int, default=DEFAULT_LECTURES)
+    parser.add_argument("--questions", type=int, default=bot.QUESTIONS_PER_LECTURE)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-mode", choices=("off", "text", "json"), default="off",
+                        help="log the handlers' INFO records to /dev/null, to measure what logging costs")
+    args = parser.parse_args(argv[1:])
+
+    if args.log_mode == "off":
+        logging.getLogger().setLevel(logging.WARNING)  # bot.py logs every button press at INFO
+    else:
+        setup_logging(args.log_mode, logging.INFO, sample_every=bot.LOG_SAMPLE_EVERY,
+                      stream=open(os.devnull, 'w', encoding='utf-8'))
+
+    with tempfile.TemporaryDirectory(prefix="quiz-load-test-") as data_dir:
+        write_question_bank(os.path.join(data_dir, "questions"), args.lectures, args.questions)
+        isolate_bot(data_dir)
+        recorder, chat, elapsed, blocks_retained = asyncio.run(
+            run_load(args.students, args.concurrency, args.api_latency / 1000, args.seed))
+        peak_bytes = asyncio.run(measure_allocations(args.seed))
+        bot.leaderboard_store.close()
+        bot.session_backend.close()
+    report(recorder, chat, elapsed, blocks_retained, peak_bytes, args.students)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Logging setup for the bot: plain text, or queued JSON written by a background thread.
+
+In "json" mode a handler hands each record to a queue without formatting it.
+A QueueListener thread then formats the message, serializes it as one JSON
+object per line and writes it out, so the event loop never pays for
+formatting or I/O. Structured fields passed with `extra=` (user_id,
+action, ...) become keys of the JSON object.
+
+Records carrying an `event` listed in `sample_every` are sampled in both
+modes: only one in N is kept, and kept records note the rate in
+`sample_every`. Records at WARNING or above are never sampled. In "json"
+mode, INFO records are also dropped and counted when the queue is full,
+rather than stalling the handlers. Warnings and errors wait for space
+instead.
+"""
+
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, extra fields and the exception, if any"""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in `sample_every[event]` records of each sampled event; WARNING and above always pass"""
+
+    def __init__(self, sample_every):
+        super().__init__()
+        self.sample_every = {event: every for event, every in sample_every.items() if every > 1}
+        self._seen = dict.fromkeys(self.sample_every, 0)
+        self.dropped = 0
+
+    def filter(self, record):
+        event = getattr(record, "event", None)
+        every = self.sample_every.get(event)
+        if every is None or record.levelno >= logging.WARNING:
+            return True
+        seen = self._seen[event] = self._seen[event] + 1
+        if seen % every:
+            self.dropped += 1
+            return False
+        record.sample_every = every
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock handler formats the message before queueing it; here the
+    record is queued as is. Callers must therefore pass arguments that are
+    not modified after the call, which holds for the ids and numbers the
+    handlers log.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(mode="text", level=logging.INFO, sample_every=None, queue_size=10000, stream=None):
+    """Replace the root logger's handlers. Returns the QueueListener in "json" mode, else None.
+
+    The listener is stopped, writing out what is still queued, when the process exits.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(level)
+
+    listener = None
+    if mode == "text":
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    elif mode == "json":
+        writer = logging.StreamHandler(stream)
+        writer.setFormatter(JsonFormatter())
+        handler = LazyQueueHandler(queue.Queue(maxsize=queue_size))
+        listener = logging.handlers.QueueListener(handler.queue, writer)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        raise ValueError(f"Unknown log mode {mode!r}, expected 'text' or 'json'")
+
+    if sample_every:
+        handler.addFilter(SamplingFilter(sample_every))
+    root.addHandler(handler)
+    return listener
+
+
+if __name__ == '__main__':
+    # Show what the JSON output looks like
+    setup_logging("json", sample_every={"button_press": 2}, stream=sys.stdout)
+    for i in range(4):
+        logger.info("User %s pressed %s", 42, "ANSWER", extra={"event": "button_press", "user_id": 42})
+    logger.error("An error is never sampled", extra={"event": "button_press"})
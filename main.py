@@ -3,10 +3,14 @@
 
 import os
 import json
+import asyncio
 import logging
 import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, CallbackContext
+
+from json_store import read_json, write_json, archive_json
+from question_timers import TimingWheel
 
 # Enable logging
 logging.basicConfig(
@@ -22,6 +26,7 @@ SUBJECTS = ["Internet Technology", "Software Engineering", "Data Structures", "C
 LECTURES_PER_SUBJECT = 14  # Default, can be modified
 QUESTIONS_PER_LECTURE = 10
 TIMER_SECONDS = 30
+TIMER_TICK_SECONDS = 0.5  # How often expired question timers are checked
 
 # File paths
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -51,31 +56,39 @@ LOW_SCORE_RESPONSES = [
 # User session storage
 user_data = {}
 
+# Timer of the question each user has on screen
+question_timers = TimingWheel(tick_seconds=TIMER_TICK_SECONDS)
+
 def get_or_create_leaderboard():
     """Get existing leaderboard or create a new one"""
     current_month = datetime.datetime.now().strftime("%Y-%B")
-    
-    if os.path.exists(LEADERBOARD_FILE):
-        with open(LEADERBOARD_FILE, 'r', encoding='utf-8') as f:
-            leaderboard = json.load(f)
-            # Reset if month changed
-            if leaderboard.get("version") != current_month:
-                leaderboard = {
-                    "version": current_month,
-                    "users": {}
-                }
-    else:
-        leaderboard = {
-            "version": current_month,
-            "users": {}
-        }
-    
+
+    try:
+        leaderboard = read_json(LEADERBOARD_FILE)
+    except ValueError as e:
+        # Keep the damaged file for inspection instead of overwriting it
+        logger.error(f"{e}. Moving it aside and starting an empty leaderboard.")
+        os.replace(LEADERBOARD_FILE, LEADERBOARD_FILE + ".corrupt")
+        leaderboard = None
+
+    if leaderboard is not None and leaderboard.get("version") == current_month:
+        return leaderboard
+
+    leaderboard_to_archive = leaderboard
+    leaderboard = {
+        "version": current_month,
+        "users": {}
+    }
+    if leaderboard_to_archive is not None:
+        # Keep last month's scores, e.g. leaderboard-2025-May.json, and start fresh
+        archive_json(LEADERBOARD_FILE, leaderboard_to_archive.get("version") or "unknown", leaderboard_to_archive)
+        save_leaderboard(leaderboard)
+
     return leaderboard
 
 def save_leaderboard(leaderboard):
     """Save leaderboard to file"""
-    with open(LEADERBOARD_FILE, 'w', encoding='utf-8') as f:
-        json.dump(leaderboard, f, ensure_ascii=False, indent=2)
+    write_json(LEADERBOARD_FILE, leaderboard)
 
 def get_or_create_question_file(subject, lecture_num):
     """Get existing question file or create a sample one"""
@@ -113,7 +126,7 @@ def get_or_create_question_file(subject, lecture_num):
     with open(file_path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def start(update: Update, context: CallbackContext) -> None:
+async def start(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /start is issued."""
     user = update.effective_user
     keyboard = [
@@ -122,42 +135,45 @@ def start(update: Update, context: CallbackContext) -> None:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    update.message.reply_text(
+    await update.message.reply_text(
         f'مرحباً {user.first_name}! 👋\n\n'
         f'أنا بوت الاختبارات الأكاديمية. اختر موضوعاً للبدء في الاختبار أو اعرض لوحة المتصدرين.',
         reply_markup=reply_markup
     )
 
-def button_callback(update: Update, context: CallbackContext) -> None:
+async def button_callback(update: Update, context: CallbackContext) -> None:
     """Handle button callbacks."""
     query = update.callback_query
-    query.answer()
+    await query.answer()
     
     data = query.data
     user_id = str(update.effective_user.id)
     
+    if not data.startswith('answer_'):
+        question_timers.cancel(user_id)  # The timed question is leaving the screen
+    
     if data == 'choose_subject':
-        show_subjects(update, context)
+        await show_subjects(update, context)
     elif data == 'leaderboard':
-        show_leaderboard(update, context)
+        await show_leaderboard(update, context)
     elif data.startswith('subject_'):
         subject_index = int(data.split('_')[1])
-        show_lectures(update, context, subject_index)
+        await show_lectures(update, context, subject_index)
     elif data.startswith('lecture_'):
         parts = data.split('_')
         subject_index = int(parts[1])
         lecture_num = int(parts[2])
-        start_quiz(update, context, subject_index, lecture_num)
+        await start_quiz(update, context, subject_index, lecture_num)
     elif data.startswith('answer_'):
         parts = data.split('_')
         selected_option = int(parts[1])
-        handle_answer(update, context, selected_option)
+        await handle_answer(update, context, selected_option)
     elif data == 'next_question':
-        show_next_question(update, context)
+        await show_next_question(update, context)
     elif data == 'main_menu':
-        show_main_menu(update, context)
+        await show_main_menu(update, context)
 
-def show_subjects(update: Update, context: CallbackContext) -> None:
+async def show_subjects(update: Update, context: CallbackContext) -> None:
     """Show available subjects."""
     keyboard = []
     for i, subject in enumerate(SUBJECTS):
@@ -167,12 +183,12 @@ def show_subjects(update: Update, context: CallbackContext) -> None:
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     query = update.callback_query
-    query.edit_message_text(
+    await query.edit_message_text(
         text="اختر الموضوع الذي ترغب في اختباره:",
         reply_markup=reply_markup
     )
 
-def show_lectures(update: Update, context: CallbackContext, subject_index: int) -> None:
+async def show_lectures(update: Update, context: CallbackContext, subject_index: int) -> None:
     """Show available lectures for a subject."""
     subject = SUBJECTS[subject_index]
     keyboard = []
@@ -193,18 +209,18 @@ def show_lectures(update: Update, context: CallbackContext, subject_index: int)
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     query = update.callback_query
-    query.edit_message_text(
+    await query.edit_message_text(
         text=f"اختر المحاضرة من {subject}:",
         reply_markup=reply_markup
     )
 
-def start_quiz(update: Update, context: CallbackContext, subject_index: int, lecture_num: int) -> None:
+async def start_quiz(update: Update, context: CallbackContext, subject_index: int, lecture_num: int) -> None:
     """Start a quiz for the selected subject and lecture."""
     user_id = str(update.effective_user.id)
     subject = SUBJECTS[subject_index]
     
     # Load questions
-    questions = get_or_create_question_file(subject, lecture_num)
+    questions = await asyncio.to_thread(get_or_create_question_file, subject, lecture_num)
     
     # Initialize user session
     user_data[user_id] = {
@@ -217,7 +233,7 @@ def start_quiz(update: Update, context: CallbackContext, subject_index: int, lec
     }
     
     query = update.callback_query
-    query.edit_message_text(
+    await query.edit_message_text(
         text=f"بدء الاختبار: {subject} - المحاضرة {lecture_num}\n"
              f"عدد الأسئلة: {len(questions['questions'])}\n"
              f"الوقت لكل سؤال: {TIMER_SECONDS} ثانية\n\n"
@@ -225,22 +241,22 @@ def start_quiz(update: Update, context: CallbackContext, subject_index: int, lec
     )
     
     # Show first question
-    show_next_question(update, context)
+    await show_next_question(update, context)
 
-def show_next_question(update: Update, context: CallbackContext) -> None:
+async def show_next_question(update: Update, context: CallbackContext) -> None:
     """Show the next question in the quiz."""
     query = update.callback_query
     user_id = str(update.effective_user.id)
     
     if user_id not in user_data:
-        query.edit_message_text("حدث خطأ. يرجى بدء اختبار جديد.")
+        await query.edit_message_text("حدث خطأ. يرجى بدء اختبار جديد.")
         return
     
     session = user_data[user_id]
     
     # Check if quiz is complete
     if session['current_question'] >= len(session['questions']):
-        show_quiz_results(update, context)
+        await show_quiz_results(update, context)
         return
     
     # Get current question
@@ -255,37 +271,36 @@ def show_next_question(update: Update, context: CallbackContext) -> None:
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     # Display question with timer
-    query.edit_message_text(
+    await query.edit_message_text(
         text=f"سؤال {question_idx + 1}/{len(session['questions'])}\n\n"
              f"⏱️ {TIMER_SECONDS} ثانية\n\n"
              f"{question['text']}",
         reply_markup=reply_markup
     )
     
-    # Set timer for auto-advancing if no answer
-    context.job_queue.run_once(
-        question_timeout, 
-        TIMER_SECONDS,
-        context={'update': update, 'user_id': user_id}
-    )
+    # Set timer for auto-advancing if no answer (replaces the previous question's timer)
+    message = query.message
+    question_timers.schedule(user_id, TIMER_SECONDS, (question_idx, message.chat_id, message.message_id))
 
-def question_timeout(context: CallbackContext) -> None:
+async def expire_question_timers(context: CallbackContext) -> None:
+    """Periodic job: time out the questions whose timer ran out."""
+    for user_id, (question_idx, chat_id, message_id) in question_timers.advance():
+        context.application.create_task(question_timeout(context.bot, user_id, question_idx, chat_id, message_id))
+
+async def question_timeout(bot, user_id, question_idx, chat_id, message_id) -> None:
     """Handle question timeout."""
-    job = context.job
-    user_id = job.context['user_id']
-    update = job.context['update']
-    
     if user_id in user_data:
         session = user_data[user_id]
         current_q = session['current_question']
         
         # Only advance if still on the same question (user hasn't answered)
-        if current_q < len(session['questions']):
+        if current_q == question_idx:
             session['current_question'] += 1
             
             # Show timeout message
-            query = update.callback_query
-            query.edit_message_text(
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
                 text="⏱️ انتهى الوقت!\n\n"
                      "لم يتم اختيار إجابة في الوقت المحدد.",
                 reply_markup=InlineKeyboardMarkup([
@@ -293,18 +308,19 @@ def question_timeout(context: CallbackContext) -> None:
                 ])
             )
 
-def handle_answer(update: Update, context: CallbackContext, selected_option: int) -> None:
+async def handle_answer(update: Update, context: CallbackContext, selected_option: int) -> None:
     """Handle user answer selection."""
     query = update.callback_query
     user_id = str(update.effective_user.id)
     
     if user_id not in user_data:
-        query.edit_message_text("حدث خطأ. يرجى بدء اختبار جديد.")
+        await query.edit_message_text("حدث خطأ. يرجى بدء اختبار جديد.")
         return
     
     session = user_data[user_id]
     question_idx = session['current_question']
     question = session['questions'][question_idx]
+    question_timers.cancel(user_id)
     
     # Check if answer is correct
     is_correct = selected_option == question['correct']
@@ -330,21 +346,21 @@ def handle_answer(update: Update, context: CallbackContext, selected_option: int
     session['current_question'] += 1
     
     # Show feedback
-    query.edit_message_text(
+    await query.edit_message_text(
         text=feedback,
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("التالي", callback_data='next_question')]
         ])
     )
 
-def show_quiz_results(update: Update, context: CallbackContext) -> None:
+async def show_quiz_results(update: Update, context: CallbackContext) -> None:
     """Show quiz results and update leaderboard."""
     query = update.callback_query
     user_id = str(update.effective_user.id)
     user = update.effective_user
     
     if user_id not in user_data:
-        query.edit_message_text("حدث خطأ. يرجى بدء اختبار جديد.")
+        await query.edit_message_text("حدث خطأ. يرجى بدء اختبار جديد.")
         return
     
     session = user_data[user_id]
@@ -354,7 +370,7 @@ def show_quiz_results(update: Update, context: CallbackContext) -> None:
     lecture = session['lecture']
     
     # Update leaderboard
-    leaderboard = get_or_create_leaderboard()
+    leaderboard = await asyncio.to_thread(get_or_create_leaderboard)
     if user_id not in leaderboard['users']:
         leaderboard['users'][user_id] = {
             'name': user.first_name,
@@ -364,7 +380,7 @@ def show_quiz_results(update: Update, context: CallbackContext) -> None:
     
     leaderboard['users'][user_id]['score'] += score
     leaderboard['users'][user_id]['last_active'] = datetime.datetime.now().strftime("%Y-%m-%d")
-    save_leaderboard(leaderboard)
+    await asyncio.to_thread(save_leaderboard, leaderboard)
     
     # Get user position
     sorted_users = sorted(leaderboard['users'].items(), 
@@ -380,7 +396,7 @@ def show_quiz_results(update: Update, context: CallbackContext) -> None:
     else:
         result_message = f"أحسنت! حصلت على {score} من {total}. 🎯"
     
-    query.edit_message_text(
+    await query.edit_message_text(
         text=f"انتهى الاختبار: {subject} - المحاضرة {lecture}\n\n"
              f"النتيجة: {score}/{total}\n\n"
              f"{result_message}",
@@ -392,9 +408,9 @@ def show_quiz_results(update: Update, context: CallbackContext) -> None:
     # Clean up session
     del user_data[user_id]
 
-def show_leaderboard(update: Update, context: CallbackContext) -> None:
+async def show_leaderboard(update: Update, context: CallbackContext) -> None:
     """Show the leaderboard."""
-    leaderboard = get_or_create_leaderboard()
+    leaderboard = await asyncio.to_thread(get_or_create_leaderboard)
     
     # Sort users by score
     sorted_users = sorted(leaderboard['users'].items(), 
@@ -419,14 +435,14 @@ def show_leaderboard(update: Update, context: CallbackContext) -> None:
             message += f"{i+1}. {medal}{user_data['name']}: {user_data['score']} نقطة\n"
     
     query = update.callback_query
-    query.edit_message_text(
+    await query.edit_message_text(
         text=message,
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("العودة إلى القائمة الرئيسية", callback_data='main_menu')]
         ])
     )
 
-def show_main_menu(update: Update, context: CallbackContext) -> None:
+async def show_main_menu(update: Update, context: CallbackContext) -> None:
     """Show the main menu."""
     keyboard = [
         [InlineKeyboardButton("Choose Subject 📚", callback_data='choose_subject')],
@@ -435,7 +451,7 @@ def show_main_menu(update: Update, context: CallbackContext) -> None:
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     query = update.callback_query
-    query.edit_message_text(
+    await query.edit_message_text(
         text='مرحباً بك في بوت الاختبارات الأكاديمية! 👋\n\n'
              'اختر موضوعاً للبدء في الاختبار أو اعرض لوحة المتصدرين.',
         reply_markup=reply_markup
@@ -443,21 +459,23 @@ def show_main_menu(update: Update, context: CallbackContext) -> None:
 
 def main() -> None:
     """Start the bot."""
-    # Create the Updater and pass it your bot's token
-    updater = Updater(TOKEN)
-
-    # Get the dispatcher to register handlers
-    dispatcher = updater.dispatcher
+    # Create the Application and pass it your bot's token.
+    # Updates are handled one at a time: user_data and leaderboard.json have no per-user locking here
+    # (bot.py is the concurrent variant).
+    application = Application.builder().token(TOKEN).concurrent_updates(False).build()
 
     # Register command handlers
-    dispatcher.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("start", start))
     
     # Register callback query handler
-    dispatcher.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(CallbackQueryHandler(button_callback))
+
+    # One repeating job drives all question timers
+    application.job_queue.run_repeating(expire_question_timers, interval=TIMER_TICK_SECONDS,
+                                        first=TIMER_TICK_SECONDS)
 
     # Start the Bot
-    updater.start_polling()
-    updater.idle()
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Handler and Bot API instrumentation, served in the Prometheus text format.
+
+Handlers and outgoing requests are timed into fixed-bucket histograms, one
+per action or API method. Each observation costs one bisect and a few
+additions, and no lock is needed because everything is recorded on the
+event loop. Gauges (live sessions, leaderboard size, the components' stats()
+counters) are only read when /metrics is scraped.
+
+`python metrics.py [port]` serves a few fake observations locally:
+
+    curl http://127.0.0.1:9100/metrics
+"""
+
+import sys
+import time
+import asyncio
+import logging
+import functools
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a cached menu edit up to a slow Bot API round trip
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Latency histograms and error counts for handlers and Bot API requests, plus gauges read on demand"""
+
+    def __init__(self, namespace="quizbot", buckets=DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self._handlers = {}  # handler name -> Histogram
+        self._handler_errors = {}  # handler name -> count
+        self._requests = {}  # API method -> Histogram
+        self._request_errors = {}  # API method -> count
+        self._gauges = []  # (name, help, read)
+        self._stats = []  # (prefix, help, stats)
+
+    def observe_handler(self, name, seconds, failed=False):
+        histogram = self._handlers.get(name)
+        if histogram is None:
+            histogram = self._handlers[name] = Histogram(self.buckets)
+        histogram.observe(seconds)
+        if failed:
+            self._handler_errors[name] = self._handler_errors.get(name, 0) + 1
+
+    def observe_request(self, endpoint, seconds, failed=False):
+        histogram = self._requests.get(endpoint)
+        if histogram is None:
+            histogram = self._requests[endpoint] = Histogram(self.buckets)
+        histogram.observe(seconds)
+        if failed:
+            self._request_errors[endpoint] = self._request_errors.get(endpoint, 0) + 1
+
+    def add_gauge(self, name, help_text, read):
+        """Export read() as gauge `name`"""
+        self._gauges.append((name, help_text, read))
+
+    def add_stats(self, prefix, help_text, stats):
+        """Export every numeric value of the dict returned by stats() as gauge `prefix_<key>`"""
+        self._stats.append((prefix, help_text, stats))
+
+    def read_gauges(self):
+        """Current gauge values as [(name, help, value)]. May block, so scrapes call it off the event loop."""
+        values = []
+        for name, help_text, read in self._gauges:
+            try:
+                values.append((name, help_text, read()))
+            except Exception as e:
+                logger.warning(f"Could not read gauge {name}: {e}")
+        for prefix, help_text, stats in self._stats:
+            try:
+                snapshot = stats()
+            except Exception as e:
+                logger.warning(f"Could not read {prefix} stats: {e}")
+                continue
+            for key, value in snapshot.items():
+                if isinstance(value, (int, float)):
+                    values.append((f"{prefix}_{key}", f"{help_text} ({key})", value))
+        return values
+
+    def _render_histograms(self, lines, name, help_text, label, histograms, errors):
+        name = f"{self.namespace}_{name}"
+        lines.append(f"# HELP {name}_seconds {help_text}")
+        lines.append(f"# TYPE {name}_seconds histogram")
+        for key, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{name}_seconds_bucket{{{label}="{key}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_seconds_sum{{{label}="{key}"}} {histogram.sum!r}')
+            lines.append(f'{name}_seconds_count{{{label}="{key}"}} {cumulative}')
+        lines.append(f"# HELP {name}_errors_total {help_text.rstrip('.')} that raised an error.")
+        lines.append(f"# TYPE {name}_errors_total counter")
+        for key in sorted(histograms):
+            lines.append(f'{name}_errors_total{{{label}="{key}"}} {errors.get(key, 0)}')
+
+    def render(self, gauge_values=None):
+        """The Prometheus text exposition of everything recorded so far"""
+        lines = []
+        self._render_histograms(lines, "handler", "Time spent handling an update, by action.", "action",
+                                self._handlers, self._handler_errors)
+        self._render_histograms(lines, "telegram_request", "Duration of Bot API requests, by method.", "method",
+                                self._requests, self._request_errors)
+        for name, help_text, value in gauge_values if gauge_values is not None else self.read_gauges():
+            name = f"{self.namespace}_{name}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def instrumented(metrics, name):
+    """Decorator timing every call of an async handler as `name`"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = await handler(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                metrics.observe_handler(name, time.perf_counter() - started, failed)
+        return wrapper
+    return decorator
+
+
+class MetricsServer:
+    """Answers GET `path` with the metrics page; anything else gets a 404."""
+
+    def __init__(self, metrics, host="127.0.0.1", port=9100, path="/metrics"):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.path = path
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve_client, self.host, self.port)
+        logger.info(f"Metrics served on http://{self.host}:{self.port}{self.path}.")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve_client(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            request_line = head.decode("latin-1").split("\r\n", 1)[0].split(" ")
+            if len(request_line) == 3 and request_line[0] == "GET" and request_line[1].split("?", 1)[0] == self.path:
+                gauges = await asyncio.to_thread(self.metrics.read_gauges)
+                status, body = "200 OK", self.metrics.render(gauges).encode("utf-8")
+            else:
+                status, body = "404 Not Found", b""
+            writer.write((f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                          f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+async def _serve_for_testing(port):
+    metrics = Metrics()
+    for seconds in (0.0004, 0.003, 0.02, 0.3):
+        metrics.observe_handler("ANSWER", seconds)
+    metrics.observe_handler("start", 0.001, failed=True)
+    metrics.observe_request("editMessageText", 0.12)
+    metrics.add_gauge("example_gauge", "A constant, to show how gauges look.", lambda: 42)
+    server = MetricsServer(metrics, port=port)
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    try:
+        asyncio.run(_serve_for_testing(int(sys.argv[1]) if len(sys.argv) > 1 else 9100))
+    except KeyboardInterrupt:
+        pass
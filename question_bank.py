@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+import threading
+
+from bank_compiler import CompiledBank, LECTURE_FILE_PATTERN
+from question_validation import validate_lecture, format_problems
+
+logger = logging.getLogger(__name__)
+
+
+def subject_dir_name(subject):
+    """Return the directory name used for a subject under the questions directory"""
+    return subject.lower().replace(" ", "_")
+
+
+class QuestionBank:
+    """In-memory copy of every lecture file, reloaded per file when it changes on disk.
+
+    Handlers only call get_lecture(), which is a dict lookup. All filesystem
+    access happens in load_all() and refresh(), which are meant to be
+    run at startup and from a periodic job.
+
+    If a compiled bank file (see bank_compiler.py) exists, load_all() only
+    memory-maps it and reads its index; each lecture is decoded from the map
+    the first time it is asked for. load_all() then runs refresh(), so lecture
+    files edited or added after the bank was compiled are served from the start.
+
+    Every lecture is validated as it is loaded (see question_validation.py):
+    its questions become Question records and invalid ones are left out and
+    listed by report().
+    """
+
+    def __init__(self, questions_dir, subjects, compiled_path=None):
+        self.questions_dir = questions_dir
+        self.subjects = list(subjects)
+        self.compiled_path = compiled_path
+        self._lectures = {}  # (subject, lecture_num) -> {"lecture": n, "questions": [Question, ...]}
+        self._stamps = {}    # (subject, lecture_num) -> (mtime_ns, size) of the loaded file
+        self._compiled = None
+        self._compiled_keys = {}  # (subject, lecture_num) -> (subject_dir, lecture_num) not decoded yet
+        self._problems = {}  # (subject, lecture_num) -> [(question index, reason)] found when it was loaded
+        self._lock = threading.Lock()
+
+    def lecture_path(self, subject, lecture_num):
+        """Path of the JSON file for a subject/lecture pair"""
+        return os.path.join(self.questions_dir, subject_dir_name(subject), f"lecture{lecture_num}.json")
+
+    def _scan(self):
+        """Yield (key, path, stamp) for every lecture file currently on disk"""
+        for subject in self.subjects:
+            subject_dir = os.path.join(self.questions_dir, subject_dir_name(subject))
+            try:
+                entries = list(os.scandir(subject_dir))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                match = LECTURE_FILE_PATTERN.match(entry.name)
+                if not match or not entry.is_file():
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue  # Removed between scandir() and stat()
+                yield (subject, int(match.group(1))), entry.path, (st.st_mtime_ns, st.st_size)
+
+    def _read(self, key, path):
+        """Parse and validate one lecture file, returning None if it can't be used"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                content = json.load(f)
+        except (OSError, ValueError) as e:  # ValueError covers bad JSON and non-UTF-8 files
+            logger.error(f"Error loading question file {path}: {e}")
+            self._problems[key] = [(None, str(e))]
+            return None
+        return self._validate(key, content, path)
+
+    def _validate(self, key, content, source):
+        """Normalized content of a parsed lecture, recording what was wrong with it"""
+        content, problems = validate_lecture(content, key[1])
+        if problems:
+            self._problems[key] = problems
+            for line in format_problems(source, problems):
+                logger.warning(f"Invalid question data, left out: {line}")
+        else:
+            self._problems.pop(key, None)
+        return content
+
+    def _load_compiled(self):
+        """Map the compiled bank file and index it. Returns False if there is none."""
+        if not self.compiled_path or not os.path.exists(self.compiled_path):
+            return False
+        try:
+            compiled = CompiledBank(self.compiled_path)
+        except (IOError, ValueError) as e:
+            logger.error(f"Error opening compiled question bank {self.compiled_path}: {e}. Loading JSON files.")
+            return False
+        by_dir = {subject_dir_name(subject): subject for subject in self.subjects}
+        stamps = {}
+        compiled_keys = {}
+        for (subject_dir, lecture_num), (_, _, stamp) in compiled.index.items():
+            subject = by_dir.get(subject_dir)
+            if subject is not None:
+                stamps[(subject, lecture_num)] = stamp
+                compiled_keys[(subject, lecture_num)] = (subject_dir, lecture_num)
+        with self._lock:
+            if self._compiled is not None:
+                self._compiled.close()
+            self._compiled = compiled
+            self._compiled_keys = compiled_keys
+            self._lectures = {}
+            self._stamps = stamps
+            self._problems = {}
+        logger.info(f"Question bank mapped {len(compiled_keys)} lectures from {self.compiled_path}.")
+        return True
+
+    def load_all(self):
+        """Load every lecture, replacing whatever is cached"""
+        if self._load_compiled():
+            self.refresh()  # One stat scan: JSON files changed since compiling take precedence
+            return len(self)
+        lectures = {}
+        stamps = {}
+        self._problems = {}
+        for key, path, stamp in self._scan():
+            stamps[key] = stamp
+            content = self._read(key, path)
+            if content is not None:
+                lectures[key] = content
+        with self._lock:
+            self._lectures = lectures
+            self._stamps = stamps
+        logger.info(f"Question bank loaded {len(lectures)} lectures from {self.questions_dir} "
+                    f"({len(self._problems)} with invalid questions).")
+        return len(lectures)
+
+    def refresh(self):
+        """Reload only the lecture files whose mtime or size changed. Returns the number of changed lectures."""
+        seen = set()
+        changed = 0
+        for key, path, stamp in self._scan():
+            seen.add(key)
+            if self._stamps.get(key) == stamp:
+                continue
+            content = self._read(key, path)
+            with self._lock:
+                self._stamps[key] = stamp  # Not retried until the file changes again
+                if content is not None:
+                    self._lectures[key] = content
+                    self._compiled_keys.pop(key, None)
+            if content is None:
+                # A broken edit keeps the previously loaded questions in service
+                logger.warning(f"Question bank kept the previous version of {key[0]} - Lecture {key[1]}: "
+                               f"{path} could not be loaded.")
+                continue
+            changed += 1
+            logger.info(f"Question bank reloaded {key[0]} - Lecture {key[1]} from {path}.")
+
+        removed = [key for key in self._stamps if key not in seen]
+        if removed:
+            with self._lock:
+                for key in removed:
+                    self._stamps.pop(key, None)
+                    self._lectures.pop(key, None)
+                    self._compiled_keys.pop(key, None)
+                    self._problems.pop(key, None)
+            changed += len(removed)
+            logger.info(f"Question bank dropped {len(removed)} deleted lecture file(s).")
+        return changed
+
+    def get_lecture(self, subject, lecture_num):
+        """Return the cached content for a lecture, or None if it isn't in the bank"""
+        key = (subject, lecture_num)
+        content = self._lectures.get(key)
+        if content is None and key in self._compiled_keys:
+            content = self._decode_compiled(key)
+        return content
+
+    def _decode_compiled(self, key):
+        """Decode a lecture from the mapped bank file on first use"""
+        with self._lock:
+            content = self._lectures.get(key)
+            compiled_key = self._compiled_keys.pop(key, None)
+            if content is not None or compiled_key is None:
+                return content
+            recorded = self._problems.get(key)  # Set by refresh() when an edit of the file couldn't be read
+            content = self._validate(key, self._compiled.read(*compiled_key), self.compiled_path)
+            if recorded is not None:
+                self._problems[key] = recorded  # The broken file on disk is what needs fixing
+            if content is not None:
+                self._lectures[key] = content
+            return content
+
+    def report(self):
+        """{(subject, lecture_num): [(question index, reason), ...]} for every lecture with invalid data.
+
+        The index is None when the whole file was unusable.
+        """
+        return {key: list(problems) for key, problems in self._problems.items()}
+
+    def available_lectures(self):
+        """{subject: sorted lecture numbers} of the lectures that can be started, for building menus"""
+        with self._lock:
+            keys = [key for key, content in self._lectures.items() if content["questions"]]
+            keys.extend(self._compiled_keys)  # Not decoded yet, so not validated yet either
+        available = {subject: [] for subject in self.subjects}
+        for subject, lecture_num in keys:
+            available[subject].append(lecture_num)
+        return {subject: tuple(sorted(numbers)) for subject, numbers in available.items()}
+
+    def __len__(self):
+        return len(self._lectures) + len(self._compiled_keys)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Per-question time limits for timed quizzes.
+
+All question timers live in one hashed timing wheel instead of a scheduler
+job each: scheduling and cancelling are dict operations on one slot, and a
+periodic tick only looks at the slots whose time has come. Each key (a user)
+has at most one timer, so showing the next question replaces the previous
+one and answering cancels it.
+
+`python question_timers.py [timers]` runs the wheel against a simulated
+clock and checks that every timer fires on time and no cancelled one fires.
+"""
+
+import sys
+import time
+import random
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ManualClock:
+    """A clock that only moves when told to, for driving the wheel in simulations"""
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class _Timer:
+    __slots__ = ('slot', 'rounds', 'due', 'data')
+
+    def __init__(self, slot, rounds, due, data):
+        self.slot = slot
+        self.rounds = rounds  # Full turns of the wheel left before it fires
+        self.due = due
+        self.data = data
+
+
+class TimingWheel:
+    """Hashed timing wheel of `slots` buckets, each `tick_seconds` wide.
+
+    A timer fires on the first tick at or after its due time, so at most one
+    tick late. advance() must be called regularly (e.g. from a repeating job);
+    it returns the timers that expired since the previous call.
+    """
+
+    def __init__(self, tick_seconds=0.5, slots=128, clock=time.monotonic):
+        self.tick_seconds = tick_seconds
+        self._clock = clock
+        self._started = clock()
+        self._ticks = 0  # Ticks processed so far
+        self._slots = [{} for _ in range(slots)]  # key -> _Timer, by slot
+        self._timers = {}  # key -> _Timer
+        self.fired = 0
+        self.cancelled = 0
+
+    def schedule(self, key, delay, data=None):
+        """Start (or restart) the timer for `key`, firing after `delay` seconds with `data`"""
+        self.cancel(key)
+        due = self._clock() + delay
+        due_tick = max(self._ticks + 1, -int(-(due - self._started) // self.tick_seconds))
+        ahead = due_tick - self._ticks
+        slot = due_tick % len(self._slots)
+        timer = _Timer(slot, (ahead - 1) // len(self._slots), due, data)
+        self._slots[slot][key] = timer
+        self._timers[key] = timer
+
+    def cancel(self, key):
+        """Stop the timer for `key`. Returns True if there was one."""
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        del self._slots[timer.slot][key]
+        self.cancelled += 1
+        return True
+
+    def advance(self):
+        """Process the ticks that have passed. Returns [(key, data), ...] for the timers that expired."""
+        target = int((self._clock() - self._started) // self.tick_seconds)
+        if not self._timers:
+            self._ticks = max(self._ticks, target)
+            return []
+        expired = []
+        while self._ticks < target:
+            self._ticks += 1
+            slot = self._slots[self._ticks % len(self._slots)]
+            for key, timer in list(slot.items()):
+                if timer.rounds:
+                    timer.rounds -= 1
+                    continue
+                del slot[key]
+                del self._timers[key]
+                expired.append((key, timer.data))
+        self.fired += len(expired)
+        return expired
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def __len__(self):
+        return len(self._timers)
+
+
+def simulate(timers=10000, max_delay=120, tick_seconds=0.5, cancel_ratio=0.5, seed=1):
+    """Run many timers against a ManualClock. Returns the number of problems found."""
+    rng = random.Random(seed)
+    clock = ManualClock()
+    wheel = TimingWheel(tick_seconds=tick_seconds, slots=64, clock=clock)
+    due = {}
+    for key in range(timers):
+        delay = rng.uniform(0, max_delay)
+        wheel.schedule(key, delay, data=delay)
+        due[key] = delay
+    for key in rng.sample(range(timers), int(timers * cancel_ratio)):
+        wheel.cancel(key)
+        del due[key]
+
+    problems = 0
+    while clock.now <= max_delay + 2 * tick_seconds:
+        clock.advance(rng.uniform(0, 2 * tick_seconds))  # Irregular ticks, like a busy event loop
+        for key, delay in wheel.advance():
+            if key not in due:
+                logger.error(f"Cancelled timer {key} fired.")
+                problems += 1
+                continue
+            if not delay <= clock.now < delay + 3 * tick_seconds:
+                logger.error(f"Timer {key} due at {delay:.2f}s fired at {clock.now:.2f}s.")
+                problems += 1
+            del due[key]
+    if due:
+        logger.error(f"{len(due)} timers never fired.")
+        problems += len(due)
+    print(f"{timers} timers, {wheel.cancelled} cancelled, {wheel.fired} fired, {problems} problems.")
+    return problems
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    sys.exit(1 if simulate(int(sys.argv[1]) if len(sys.argv) > 1 else 10000) else 0)
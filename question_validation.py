@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Validation and normalization of lecture files into Question records.
+
+Every question is checked once when its lecture is loaded. A valid question
+becomes a Question with its text and explanation as strings, its options as
+a tuple of at least two strings and `correct` as an index into them.
+Invalid questions are left out of the lecture and listed in a report, so the
+handlers never have to second-guess the data they are given.
+
+`python question_validation.py [questions_dir]` loads every lecture file
+into a QuestionBank and prints its report(), exiting with 1 if there are
+any problems.
+"""
+
+import os
+import sys
+import logging
+
+logger = logging.getLogger(__name__)
+
+MIN_OPTIONS = 2
+DEFAULT_EXPLANATION = 'لا يوجد شرح متاح.'
+
+
+class Question:
+    """A validated question. `correct` is always a valid index into `options`."""
+
+    __slots__ = ('text', 'options', 'correct', 'explanation')
+
+    def __init__(self, text, options, correct, explanation=DEFAULT_EXPLANATION):
+        self.text = text
+        self.options = options
+        self.correct = correct
+        self.explanation = explanation
+
+    def __repr__(self):
+        return f"Question({self.text!r}, {self.options!r}, {self.correct!r})"
+
+
+def _clean_text(value):
+    """Stripped string for a text field, or None if it isn't a non-empty string or number"""
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return None
+    return str(value).strip() or None
+
+
+def validate_question(raw):
+    """Return (Question, None) for a valid question, or (None, reason) for an invalid one"""
+    if not isinstance(raw, dict):
+        return None, "not an object"
+    text = _clean_text(raw.get("text"))
+    if text is None:
+        return None, "missing text"
+    options = raw.get("options")
+    if not isinstance(options, list):
+        return None, "missing options list"
+    options = tuple(_clean_text(option) for option in options)
+    if None in options:
+        return None, "empty or non-text option"
+    if len(options) < MIN_OPTIONS:
+        return None, f"fewer than {MIN_OPTIONS} options"
+    correct = raw.get("correct")
+    if isinstance(correct, bool) or not isinstance(correct, int) or not 0 <= correct < len(options):
+        return None, f"correct answer {correct!r} is not an index into {len(options)} options"
+    explanation = _clean_text(raw.get("explanation")) or DEFAULT_EXPLANATION
+    return Question(text, options, correct, explanation), None
+
+
+def validate_lecture(content, lecture_num):
+    """Normalize a parsed lecture file. Returns (content, problems) or (None, problems) if it is unusable.
+
+    The returned content is {"lecture": n, "questions": [Question, ...]} with
+    invalid questions left out; `problems` lists (question index, reason)
+    for each of them, with index None for problems with the file itself.
+    """
+    if not isinstance(content, dict) or not isinstance(content.get("questions"), list):
+        return None, [(None, "no 'questions' list")]
+    questions = []
+    problems = []
+    for index, raw in enumerate(content["questions"]):
+        question, reason = validate_question(raw)
+        if question is None:
+            problems.append((index, reason))
+        else:
+            questions.append(question)
+    lecture = content.get("lecture", lecture_num)
+    return {"lecture": lecture if isinstance(lecture, int) else lecture_num, "questions": questions}, problems
+
+
+def format_problems(source, problems):
+    """One line per problem, for logs and reports"""
+    return [f"{source}: " + (reason if index is None else f"question {index + 1}: {reason}")
+            for index, reason in problems]
+
+
+def main(argv):
+    from question_bank import QuestionBank  # It imports this module
+
+    questions_dir = argv[1] if len(argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                               "quiz_data", "questions")
+    logging.disable(logging.CRITICAL)  # The report below lists everything the bank would log
+    # Every subdirectory is a subject, named as its directory
+    subjects = sorted(name for name in os.listdir(questions_dir) if os.path.isdir(os.path.join(questions_dir, name)))
+    bank = QuestionBank(questions_dir, subjects)
+    loaded = bank.load_all()
+    report = bank.report()
+    lines = []
+    for (subject, lecture_num), problems in sorted(report.items()):
+        lines.extend(format_problems(bank.lecture_path(subject, lecture_num), problems))
+    for line in lines:
+        print(line)
+    unreadable = sum(1 for key in report if bank.get_lecture(*key) is None)
+    print(f"Checked {loaded + unreadable} lecture files: {len(lines)} problems.")
+    return 1 if lines else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
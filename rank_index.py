@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import threading
+
+
+class FenwickTree:
+    """Binary indexed tree of counts over score buckets 0..size-1"""
+
+    def __init__(self, size):
+        self.size = size
+        self._tree = [0] * (size + 1)
+
+    def add(self, index, delta):
+        i = index + 1
+        while i <= self.size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, index):
+        """Sum of the counts in buckets 0..index (inclusive)"""
+        total = 0
+        i = min(index, self.size - 1) + 1
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+
+class RankIndex:
+    """Incrementally maintained ranking of users by score.
+
+    A Fenwick tree over score buckets answers "how many users scored more than
+    X" in O(log max_score), so rank() never sorts the users. top() walks the
+    distinct scores from the highest down and stops after k users. Users with
+    the same score share a position and are listed in the order they reached it.
+    """
+
+    def __init__(self, capacity=1024):
+        self._lock = threading.RLock()
+        self._capacity = capacity
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._tree = FenwickTree(self._capacity)
+            self._scores = {}        # user_id -> score
+            self._buckets = {}       # score -> {user_id: None}, insertion ordered
+            self._distinct = []      # sorted distinct scores currently in use
+
+    def load(self, items):
+        """Replace the index contents with (user_id, score) pairs"""
+        with self._lock:
+            self.clear()
+            for user_id, score in items:
+                self.update(user_id, score)
+
+    def _grow(self, score):
+        capacity = self._tree.size
+        while capacity <= score:
+            capacity *= 2
+        tree = FenwickTree(capacity)
+        for value, users in self._buckets.items():
+            tree.add(value, len(users))
+        self._tree = tree
+
+    def _remove(self, user_id):
+        old = self._scores.pop(user_id, None)
+        if old is None:
+            return
+        bucket = self._buckets[old]
+        del bucket[user_id]
+        if not bucket:
+            del self._buckets[old]
+            del self._distinct[bisect.bisect_left(self._distinct, old)]
+        self._tree.add(old, -1)
+
+    def update(self, user_id, score):
+        """Set a user's score, adding the user if needed"""
+        if score < 0:
+            raise ValueError(f"Scores can't be negative (got {score} for {user_id})")
+        with self._lock:
+            if self._scores.get(user_id) == score:
+                return
+            self._remove(user_id)
+            if score >= self._tree.size:
+                self._grow(score)
+            self._scores[user_id] = score
+            bucket = self._buckets.get(score)
+            if bucket is None:
+                bucket = self._buckets[score] = {}
+                bisect.insort(self._distinct, score)
+            bucket[user_id] = None
+            self._tree.add(score, 1)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+
+    def score(self, user_id):
+        return self._scores.get(user_id)
+
+    def rank(self, user_id):
+        """1-based position of a user, or 0 if the user isn't ranked"""
+        with self._lock:
+            score = self._scores.get(user_id)
+            if score is None:
+                return 0
+            return len(self._scores) - self._tree.prefix_sum(score) + 1
+
+    def top(self, k=10):
+        """Return [(user_id, score), ...] for the k best users, highest score first"""
+        result = []
+        with self._lock:
+            for score in reversed(self._distinct):
+                for user_id in self._buckets[score]:
+                    result.append((user_id, score))
+                    if len(result) >= k:
+                        return result
+        return result
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, user_id):
+        return user_id in self._scores
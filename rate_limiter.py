@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Outbound request scheduler for the Telegram Bot API.
+
+Plugged into the Application with `.rate_limiter(...)`, so every request the
+handlers make (edit_message_text, reply_text, ...) passes through it.
+Requests addressed to a chat are held in a priority queue and released only
+when both the global bucket (about 30 messages per second for the whole bot)
+and that chat's bucket (about 1 per second) have a token. Requests without a
+chat, such as answering a callback query, are sent immediately.
+
+A pending edit of a message is replaced by a newer edit of the same message,
+so only the latest text is sent. A 429 answer pauses all sending for the
+`retry_after` Telegram asks for, and the request is queued again.
+
+With an `observe` callback, the duration of every request actually sent is
+reported as observe(endpoint, seconds, failed).
+"""
+
+import time
+import heapq
+import asyncio
+import logging
+import functools
+import contextlib
+import contextvars
+from itertools import count
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Lower numbers are sent first
+PRIORITY_FEEDBACK = 0  # Answer feedback and the next question
+PRIORITY_NORMAL = 1  # Menus, leaderboards and everything else
+
+COALESCED_ENDPOINTS = frozenset({"editMessageText", "editMessageReplyMarkup", "editMessageCaption"})
+
+_priority = contextvars.ContextVar("outbound_priority", default=PRIORITY_NORMAL)
+
+
+@contextlib.contextmanager
+def send_priority(priority):
+    """Requests made inside this block (in the current task) are queued with `priority`"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def sent_with_priority(priority):
+    """Decorator for handlers whose requests should be queued with `priority`"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            with send_priority(priority):
+                return await handler(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `capacity`"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Request:
+    __slots__ = ('priority', 'chat_id', 'endpoint', 'coalesce_key', 'callback', 'args', 'kwargs', 'waiters',
+                 'retries')
+
+    def __init__(self, priority, chat_id, endpoint, coalesce_key, callback, args, kwargs):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.endpoint = endpoint
+        self.coalesce_key = coalesce_key
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.waiters = []  # Futures of every caller whose edit this request carries
+        self.retries = 0
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """Global and per-chat token buckets with priorities, 429 handling and edit coalescing."""
+
+    def __init__(self, overall_rate=30, per_chat_rate=1, per_chat_burst=3, max_retries=3,
+                 clock=time.monotonic, observe=None):
+        self.overall_rate = overall_rate
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self._clock = clock
+        self._observe = observe
+        self._global = TokenBucket(overall_rate, overall_rate, clock())
+        self._chats = {}  # chat_id -> TokenBucket
+        self._queue = []  # (priority, seq, _Request)
+        self._seq = count()
+        self._pending_edits = {}  # (endpoint, chat_id, message_id) -> queued _Request
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._dispatcher = None
+        self._sending = set()  # In-flight _send tasks, kept referenced until they finish
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    async def initialize(self):
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch(), name="outbound-rate-limiter")
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)  # Before the HTTP client closes
+        for _, _, request in self._queue:
+            for waiter in request.waiters:
+                if not waiter.done():
+                    waiter.cancel()
+        self._queue.clear()
+        self._pending_edits.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else _priority.get()
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._dispatcher is None:
+            return await self._send_now(callback, args, kwargs, endpoint)
+
+        waiter = asyncio.get_running_loop().create_future()
+        coalesce_key = None
+        if endpoint in COALESCED_ENDPOINTS and data.get("message_id") is not None:
+            coalesce_key = (endpoint, chat_id, data["message_id"])
+            queued = self._pending_edits.get(coalesce_key)
+            if queued is not None:
+                # Not sent yet: send this edit instead and answer both callers with its result
+                queued.args, queued.kwargs = args, kwargs
+                queued.waiters.append(waiter)
+                self.coalesced += 1
+                if priority < queued.priority:
+                    queued.priority = priority
+                    heapq.heappush(self._queue, (priority, next(self._seq), queued))
+                    self._wakeup.set()
+                return await waiter
+
+        request = _Request(priority, chat_id, endpoint, coalesce_key, callback, args, kwargs)
+        request.waiters.append(waiter)
+        if coalesce_key is not None:
+            self._pending_edits[coalesce_key] = request
+        heapq.heappush(self._queue, (priority, next(self._seq), request))
+        self._wakeup.set()
+        return await waiter
+
+    async def _call(self, endpoint, callback, args, kwargs):
+        """Make the request, reporting its duration to `observe`"""
+        if self._observe is None:
+            return await callback(*args, **kwargs)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await callback(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            self._observe(endpoint, time.perf_counter() - started, failed)
+
+    async def _send_now(self, callback, args, kwargs, endpoint):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._call(endpoint, callback, args, kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self._pause(e.retry_after)
+                self.retried += 1
+                await asyncio.sleep(e.retry_after)
+
+    def _pause(self, retry_after):
+        retry_after = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else retry_after
+        self._paused_until = max(self._paused_until, self._clock() + retry_after)
+        logger.warning(f"Telegram asked to retry after {retry_after}s. Pausing outbound requests.")
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Forget chats that have been quiet long enough to have a full bucket again
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.is_full(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst, now)
+        return bucket
+
+    def _next_ready(self, now):
+        """Pop the most urgent request whose chat may send now. Returns (request, seconds to wait)."""
+        skipped = []
+        ready = None
+        wait = None
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            request = entry[2]
+            if entry[0] != request.priority:
+                continue  # Stale heap entry, the request was re-queued at a higher priority
+            if all(w.done() for w in request.waiters):
+                # Every caller gave up waiting
+                if self._pending_edits.get(request.coalesce_key) is request:
+                    del self._pending_edits[request.coalesce_key]
+                continue
+            chat_wait = self._chat_bucket(request.chat_id, now).wait_time(now)
+            if chat_wait == 0:
+                ready = request
+                break
+            skipped.append(entry)
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+        return ready, wait
+
+    async def _dispatch(self):
+        while True:
+            now = self._clock()
+            wait = max(self._paused_until - now, self._global.wait_time(now))
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            request, wait = self._next_ready(now)
+            if request is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._global.take()
+            self._chat_bucket(request.chat_id, now).take()
+            if request.coalesce_key is not None:
+                # From here on a new edit of this message is queued separately
+                self._pending_edits.pop(request.coalesce_key, None)
+            task = asyncio.create_task(self._send(request))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, request):
+        try:
+            result = await self._call(request.endpoint, request.callback, request.args, request.kwargs)
+        except RetryAfter as e:
+            self._pause(e.retry_after)
+            if request.retries < self.max_retries:
+                request.retries += 1
+                self.retried += 1
+                if request.coalesce_key is not None:
+                    newer = self._pending_edits.get(request.coalesce_key)
+                    if newer is not None:
+                        newer.waiters.extend(request.waiters)  # Superseded while it was in flight
+                        return
+                    self._pending_edits[request.coalesce_key] = request
+                heapq.heappush(self._queue, (request.priority, next(self._seq), request))
+                self._wakeup.set()
+                return
+            self._finish(request, exception=e)
+        except Exception as e:
+            self._finish(request, exception=e)
+        else:
+            self.sent += 1
+            self._finish(request, result=result)
+
+    @staticmethod
+    def _finish(request, result=None, exception=None):
+        for waiter in request.waiters:
+            if waiter.done():
+                continue
+            if exception is not None:
+                waiter.set_exception(exception)
+            else:
+                waiter.set_result(result)
+
+    def stats(self):
+        return {
+            'queued': len(self._queue),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'retried': self.retried,
+            'chats': len(self._chats)
+        }
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+
+class RenderCache:
+    """Keeps the last rendered value together with the key it was rendered for.
+
+    lookup() returns the cached value while the key is unchanged; the caller
+    renders (e.g. in a worker thread) and put()s the new value as soon as it
+    differs. Hit and miss counters are exported by stats() so the cache's
+    effectiveness can be checked at runtime.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._value = None
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """Return the cached value for key (counting a hit), or None (counting a miss)"""
+        with self._lock:
+            if self._value is not None and self._key == key:
+                self.hits += 1
+                return self._value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._key = key
+            self._value = value
+
+    def stats(self):
+        """Return {'hits', 'misses', 'hit_ratio'}"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0
+            }
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import abc
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Columns added to the sessions table after its first version, in order
+ADDED_COLUMNS = (
+    ("nonce", "INTEGER NOT NULL DEFAULT 0"),
+    ("seed", "INTEGER"),
+    ("question_count", "INTEGER"),
+)
+
+
+class SessionBackend(abc.ABC):
+    """Where quiz sessions are saved so they survive a restart.
+
+    A saved record is the tuple (subject_index, lecture, current_question,
+    score, nonce, seed, question_count); the question list itself is looked up
+    again in the question bank when a session is restored, and a shuffled
+    quiz's order is derived again from its seed. Methods are blocking and may
+    be called from worker threads.
+    """
+
+    @abc.abstractmethod
+    def load(self, user_id):
+        """Return the saved record for one user, or None"""
+
+    @abc.abstractmethod
+    def save_many(self, records):
+        """Apply {user_id: record or None} in one batch; None deletes the user's record"""
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """Sessions in a local SQLite table keyed by user id.
+
+    Loading a session is a single primary-key lookup; a batch of changes is
+    written in one transaction. Records older than `max_age_seconds` are
+    treated as abandoned and removed when the next batch is written.
+    """
+
+    def __init__(self, db_path, max_age_seconds=3600):
+        self.db_path = db_path
+        self.max_age_seconds = max_age_seconds
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    user_id TEXT PRIMARY KEY,
+                    subject_index INTEGER NOT NULL,
+                    lecture INTEGER NOT NULL,
+                    current_question INTEGER NOT NULL,
+                    score INTEGER NOT NULL,
+                    updated REAL NOT NULL,
+                    nonce INTEGER NOT NULL DEFAULT 0,
+                    seed INTEGER,
+                    question_count INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS sessions_by_updated ON sessions (updated);
+            """)
+            # Tables created by older versions lack the newer columns
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+            for column, definition in ADDED_COLUMNS:
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE sessions ADD COLUMN {column} {definition}")
+            self._conn = conn
+        return self._conn
+
+    def load(self, user_id):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT subject_index, lecture, current_question, score, nonce, seed, question_count FROM sessions "
+                "WHERE user_id = ? AND updated >= ?",
+                (user_id, time.time() - self.max_age_seconds)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def save_many(self, records):
+        now = time.time()
+        upserts = [(user_id,) + record + (now,) for user_id, record in records.items() if record is not None]
+        deletes = [(user_id,) for user_id, record in records.items() if record is None]
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            try:
+                if upserts:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO sessions "
+                        "(user_id, subject_index, lecture, current_question, score, nonce, seed, question_count, "
+                        "updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        upserts
+                    )
+                if deletes:
+                    conn.executemany("DELETE FROM sessions WHERE user_id = ?", deletes)
+                conn.execute("DELETE FROM sessions WHERE updated < ?", (now - self.max_age_seconds,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
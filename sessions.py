@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import logging
+from array import array
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class QuizSession:
+    """State of one user's quiz in progress.
+
+    `questions` is the question list held by the question bank, shared with
+    every other session on the same lecture, not a copy of it. `api_calls`
+    counts the Bot API requests made for this quiz so far. `nonce` is a random
+    32-bit id carried by the quiz's answer buttons, so presses on buttons of
+    an earlier quiz can be told apart.
+
+    With a `seed`, the quiz asks `count` questions of the lecture picked at
+    random and shows each question's options in a random order. Only the seed
+    and the array of picked question indices are kept; the option order of a
+    question is derived from the seed when it is shown. `current_question`
+    is always the position in the quiz, not in the lecture.
+    """
+
+    __slots__ = ('subject_index', 'lecture', 'questions', 'current_question', 'score', 'last_seen', 'api_calls',
+                 'nonce', 'seed', 'order', '_option_order')
+
+    def __init__(self, subject_index, lecture, questions, current_question=0, score=0, nonce=None,
+                 seed=None, count=None):
+        self.subject_index = subject_index
+        self.lecture = lecture
+        self.questions = questions
+        self.current_question = current_question
+        self.score = score
+        self.nonce = random.getrandbits(32) if nonce is None else nonce
+        self.seed = seed
+        self.order = None  # Lecture question index for each quiz position, when shuffled
+        if seed is not None:
+            count = len(questions) if count is None else min(count, len(questions))
+            self.order = array('H', random.Random(seed).sample(range(len(questions)), count))
+        self._option_order = None  # (position, original option indices in display order)
+        self.last_seen = 0.0
+        self.api_calls = 0
+
+    @property
+    def question_count(self):
+        return len(self.questions) if self.order is None else len(self.order)
+
+    def question_index(self, position):
+        """Index in the lecture's question list of the question at a quiz position"""
+        return position if self.order is None else self.order[position]
+
+    def question(self, position):
+        return self.questions[self.question_index(position)]
+
+    def option_order(self, position):
+        """Original option indices in the order they are shown for the question at `position`"""
+        cached = self._option_order
+        if cached is not None and cached[0] == position:
+            return cached[1]
+        order = list(range(len(self.question(position).options)))
+        if self.seed is not None:
+            random.Random(self.seed ^ (position + 1) << 32).shuffle(order)
+        self._option_order = (position, tuple(order))
+        return self._option_order[1]
+
+
+class SessionStore:
+    """Quiz sessions by user id, bounded by an idle TTL and a hard capacity.
+
+    Sessions are kept in least-recently-used order. get() expires a session
+    that has been idle longer than `ttl_seconds`, evict_idle() sweeps all of
+    them from the oldest end, and adding a session beyond `capacity` evicts the
+    least recently used one.
+
+    With a `backend`, every change is also queued in a dirty set that
+    take_dirty() hands over for a batched write, and a session missing from
+    memory can be restored from its saved record.
+    `resolve_questions(subject_index, lecture)` maps a saved record back to
+    the question bank's list.
+    """
+
+    def __init__(self, ttl_seconds=3600, capacity=10000, clock=time.monotonic,
+                 backend=None, resolve_questions=None):
+        self.ttl_seconds = ttl_seconds
+        self.capacity = capacity
+        self.backend = backend
+        self.resolve_questions = resolve_questions
+        self._clock = clock
+        self._sessions = OrderedDict()  # user_id -> QuizSession, least recently used first
+        self._dirty = {}  # user_id -> QuizSession to save, or None to delete
+        self.created = 0
+        self.rehydrated = 0
+        self.finished = 0
+        self.finished_api_calls = 0  # Bot API requests made by all finished quizzes
+        self.evicted_idle = 0
+        self.evicted_capacity = 0
+
+    def _track(self, user_id, session):
+        if self.backend is not None:
+            self._dirty[user_id] = session
+
+    def get(self, user_id):
+        """Return the user's live session (marking it used), or None"""
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = self._dirty.get(user_id)
+            if session is None:
+                return None
+            # Evicted for capacity before its last change was saved
+            self._sessions[user_id] = session
+        now = self._clock()
+        if now - session.last_seen > self.ttl_seconds:
+            del self._sessions[user_id]
+            self._track(user_id, None)
+            self.evicted_idle += 1
+            return None
+        session.last_seen = now
+        self._sessions.move_to_end(user_id)
+        return session
+
+    def put(self, user_id, session):
+        """Store a session for the user, replacing any previous one"""
+        session.last_seen = self._clock()
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        self._track(user_id, session)
+        self.created += 1
+        while len(self._sessions) > self.capacity:
+            evicted_id, _ = self._sessions.popitem(last=False)
+            self.evicted_capacity += 1
+            logger.info(f"Session store full ({self.capacity}). Evicted session of user {evicted_id}.")
+        return session
+
+    def mark_dirty(self, user_id):
+        """Queue the user's session to be saved after it was changed"""
+        session = self._sessions.get(user_id)
+        if session is not None:
+            self._track(user_id, session)
+
+    def pop(self, user_id):
+        """Remove and return the user's session once the quiz is over"""
+        session = self._sessions.pop(user_id, None)
+        self._track(user_id, None)
+        if session is not None:
+            self.finished += 1
+            self.finished_api_calls += session.api_calls
+        return session
+
+    def may_have_saved(self, user_id):
+        """True if a missing session is worth looking up in the backend"""
+        return self.backend is not None and user_id not in self._sessions and user_id not in self._dirty
+
+    def restore(self, user_id, record):
+        """Bring back a session from a record loaded from the backend. Returns it, or None."""
+        if record is None or user_id in self._sessions:
+            return self._sessions.get(user_id)
+        session = self._from_record(record)
+        if session is None:
+            logger.warning(f"Saved session of user {user_id} points to a missing lecture. Dropping it.")
+            self._track(user_id, None)
+            return None
+        session.last_seen = self._clock()
+        self._sessions[user_id] = session
+        self.rehydrated += 1
+        while len(self._sessions) > self.capacity:
+            self._sessions.popitem(last=False)
+            self.evicted_capacity += 1
+        return session
+
+    def _from_record(self, record):
+        """QuizSession for a saved record, or None if its lecture is gone"""
+        subject_index, lecture, current_question, score, nonce, seed, count = record
+        questions = self.resolve_questions(subject_index, lecture) if self.resolve_questions else None
+        if questions is None:
+            return None
+        return QuizSession(subject_index, lecture, questions, current_question, score, nonce, seed, count)
+
+    def requeue(self, records):
+        """Put back changes handed over by take_dirty() whose write failed, unless changed again since"""
+        for user_id, record in records.items():
+            if user_id in self._dirty:
+                continue
+            if record is None:
+                self._dirty[user_id] = None
+                continue
+            session = self._sessions.get(user_id)
+            if session is None:
+                session = self._from_record(record)  # Evicted for capacity in the meantime
+                if session is None:
+                    continue
+                session.last_seen = self._clock()
+            self._dirty[user_id] = session
+
+    def take_dirty(self):
+        """Hand over pending changes as {user_id: record or None} and clear them"""
+        dirty, self._dirty = self._dirty, {}
+        return {user_id: (None if session is None else
+                          (session.subject_index, session.lecture, session.current_question, session.score,
+                           session.nonce, session.seed, None if session.order is None else len(session.order)))
+                for user_id, session in dirty.items()}
+
+    def evict_idle(self):
+        """Drop every session idle for longer than the TTL. Returns how many were dropped."""
+        deadline = self._clock() - self.ttl_seconds
+        evicted = 0
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if session.last_seen >= deadline:
+                break  # Everything after this one was used more recently
+            del self._sessions[user_id]
+            self._track(user_id, None)
+            evicted += 1
+        self.evicted_idle += evicted
+        return evicted
+
+    def stats(self):
+        return {
+            'live': len(self._sessions),
+            'created': self.created,
+            'rehydrated': self.rehydrated,
+            'finished': self.finished,
+            'api_calls_per_quiz': self.finished_api_calls / self.finished if self.finished else 0.0,
+            'evicted_idle': self.evicted_idle,
+            'evicted_capacity': self.evicted_capacity
+        }
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import functools
+import logging
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedLock:
+    """One asyncio.Lock per key, created on demand and dropped when idle.
+
+    Holders of the same key run one at a time in arrival order (asyncio.Lock
+    wakes waiters first-in first-out); different keys never wait on each
+    other. A key's entry is removed as soon as nobody holds or waits on it, so
+    the table only ever contains keys with work in flight.
+    """
+
+    def __init__(self):
+        self._locks = {}  # key -> [asyncio.Lock, holders + waiters]
+        self.dropped = 0  # Updates turned away by serialized_per_user because their user was busy
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def run(self, key, coro):
+        """Await a coroutine while holding the key's lock"""
+        async with self.hold(key):
+            return await coro
+
+    def pending(self, key):
+        """Number of tasks holding or waiting for the key's lock"""
+        entry = self._locks.get(key)
+        return entry[1] if entry is not None else 0
+
+    def __len__(self):
+        return len(self._locks)
+
+
+def serialized_per_user(locks, max_pending=2):
+    """Decorator for handlers: updates from the same user run one after another.
+
+    The lock is taken before the handler's first await, so updates keep the
+    order in which the application started them.
+
+    A waiting update still occupies one of the application's concurrent
+    update slots, so a user may have at most `max_pending` updates running or
+    waiting; further ones (a burst of taps) are dropped instead of queueing
+    and starving everyone else of slots. A dropped button press still gets its
+    callback query answered, so the client stops showing it as loading.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context, *args, **kwargs):
+            user = getattr(update, 'effective_user', None)
+            if user is None:
+                return await handler(update, context, *args, **kwargs)
+            if locks.pending(user.id) >= max_pending:
+                locks.dropped += 1
+                logger.debug(f"Dropped an update from user {user.id}: {max_pending} already in progress.")
+                query = getattr(update, 'callback_query', None)
+                if query is not None:
+                    try:
+                        await query.answer()
+                    except Exception as e:
+                        logger.debug(f"Could not answer a dropped callback query of user {user.id}: {e}")
+                return None
+            async with locks.hold(user.id):
+                return await handler(update, context, *args, **kwargs)
+        return wrapper
+    return decorator
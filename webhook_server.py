@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Minimal HTTP ingress for Telegram webhook updates.
+
+Accepted updates go into a bounded queue that a fixed number of worker tasks
+drain. When the queue is full the server answers 503 with Retry-After, so
+Telegram backs off and redelivers instead of the bot buffering without limit.
+
+To try it without Telegram, run `python webhook_server.py` (it only logs the
+updates it receives) and POST a recorded update:
+
+    curl -X POST -H 'Content-Type: application/json' \\
+         -H 'X-Telegram-Bot-Api-Secret-Token: local-test' \\
+         --data @update.json http://127.0.0.1:8443/telegram
+"""
+
+import sys
+import hmac
+import json
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+class WebhookServer:
+    """Serves POST requests on `path` and feeds their JSON bodies to `handle_update`.
+
+    `handle_update` is a coroutine function taking the decoded update dict.
+    Requests must carry the `secret_token` in the X-Telegram-Bot-Api-Secret-Token
+    header when one is configured.
+    """
+
+    def __init__(self, handle_update, host="0.0.0.0", port=8443, path="/telegram", secret_token=None,
+                 queue_size=1000, workers=32, max_body_bytes=1024 * 1024):
+        self.handle_update = handle_update
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.workers = workers
+        self.max_body_bytes = max_body_bytes
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._server = None
+        self._worker_tasks = []
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected_full = 0
+        self.rejected_auth = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve_client, self.host, self.port)
+        self._worker_tasks = [asyncio.create_task(self._worker(), name=f"webhook-worker-{i}")
+                              for i in range(self.workers)]
+        logger.info(f"Webhook server listening on {self.host}:{self.port}{self.path} "
+                    f"(queue {self.queue.maxsize}, {self.workers} workers).")
+
+    async def stop(self, drain_timeout=10):
+        """Stop accepting requests, give queued updates a chance to finish, then stop the workers"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Webhook server stopped with {self.queue.qsize()} updates still queued.")
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    async def _worker(self):
+        while True:
+            data = await self.queue.get()
+            try:
+                await self.handle_update(data)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error processing webhook update {data.get('update_id')}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def _accept(self, method, target, headers, body):
+        """Validate one request and queue its update. Returns (status, extra headers)."""
+        if target.split("?", 1)[0] != self.path:
+            return 404, {}
+        if method != "POST":
+            return 405, {"Allow": "POST"}
+        if self.secret_token is not None and not hmac.compare_digest(
+                headers.get(SECRET_HEADER, "").encode(), self.secret_token.encode()):
+            self.rejected_auth += 1
+            return 403, {}
+        try:
+            data = json.loads(body)
+        except (ValueError, UnicodeDecodeError):
+            return 400, {}
+        if not isinstance(data, dict):
+            return 400, {}
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.rejected_full += 1
+            return 503, {"Retry-After": "1"}
+        self.received += 1
+        return 200, {}
+
+    async def _serve_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    await self._respond(writer, 400, {}, keep_alive=False)
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get("content-length", "0"))
+                except ValueError:
+                    length = -1
+                if length < 0 or length > self.max_body_bytes:
+                    await self._respond(writer, 413 if length > 0 else 400, {}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                status, extra = self._accept(method, target, headers, body)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                await self._respond(writer, status, extra, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    @staticmethod
+    async def _respond(writer, status, extra_headers, keep_alive):
+        headers = {"Content-Length": "0", "Connection": "keep-alive" if keep_alive else "close"}
+        headers.update(extra_headers)
+        head = f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write((head + "\r\n").encode("latin-1"))
+        await writer.drain()
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'received': self.received,
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected_full': self.rejected_full,
+            'rejected_auth': self.rejected_auth
+        }
+
+
+async def _serve_for_testing(port):
+    async def log_update(data):
+        logger.info(f"Received update {data.get('update_id')}: {json.dumps(data, ensure_ascii=False)[:200]}")
+
+    server = WebhookServer(log_update, host="127.0.0.1", port=port, secret_token="local-test")
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    try:
+        asyncio.run(_serve_for_testing(int(sys.argv[1]) if len(sys.argv) > 1 else 8443))
+    except KeyboardInterrupt:
+        pass